@@ -2,7 +2,6 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -11,8 +10,10 @@ from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from config import Config
 from elasticsearch import Elasticsearch
+from app.cache import LRUCache
+from app.replicas import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy() # reads from SQLALCHEMY_REPLICA_URIS when there are any, see app/replicas.py
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -35,7 +36,56 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app)
     
+    from app import replicas
+    replicas.register(app, db)
+
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    from app.search import ElasticsearchBackend, SQLiteSearchBackend, SearchCache
+    if app.config['SEARCH_BACKEND'] == 'sqlite': # local full-text index, for deployments without an Elasticsearch server
+        app.search_backend = SQLiteSearchBackend(app.config['SEARCH_INDEX_PATH'])
+    else:
+        app.search_backend = ElasticsearchBackend(app)
+    from app.search_queue import SearchQueue
+    app.search_queue = SearchQueue(app)
+    app.search_cache = SearchCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'],
+                                   app.config['SEARCH_CACHE_STALENESS'], app.config['SEARCH_CACHE_PAGES'],
+                                   app.search_queue) # the generations are kept in the queue file
+    if app.search_backend.enabled and not app.testing and len(app.search_queue): # pick up whatever was left over by the last run
+        app.search_queue.start()
+    app.follow_graph = LRUCache(app.config['FOLLOW_GRAPH_CACHE_SIZE'], app.config['FOLLOW_GRAPH_CACHE_TTL'], weigh=len,
+                                maxweight=app.config['FOLLOW_GRAPH_CACHE_IDS']) # user id -> frozenset of followed ids
+    app.user_cache = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL']) # user id -> column values, for load_user()
+
+    from app.last_seen import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app)
+
+    from app.fragments import render_post
+    app.fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], weigh=lambda entry: len(entry[1]),
+                                  maxweight=app.config['FRAGMENT_CACHE_BYTES']) # (post id, locale) -> (author version, html)
+    app.add_template_global(render_post)
+
+    from app.translate import TranslationCache, CircuitBreaker, translator_session
+    app.translation_cache = TranslationCache(app.config['TRANSLATION_CACHE_PATH'], app.config['TRANSLATION_CACHE_SIZE'])
+    app.translator_session = translator_session(app.config['TRANSLATOR_POOL_SIZE'])
+    app.translator_breaker = CircuitBreaker(app.config['TRANSLATOR_FAILURE_THRESHOLD'], app.config['TRANSLATOR_RESET_TIMEOUT'])
+
+    from app.email import MailPool
+    app.mail_pool = MailPool(app)
+
+    from app.language import LanguageDetector
+    app.language_detector = LanguageDetector(app)
+
+    from app.passwords import PasswordHasher
+    app.password_hasher = PasswordHasher(app)
+
+    from app import sql_stats
+    sql_stats.register(app)
+
+    from app import metrics
+    metrics.register(app)
+
+    from app import profiler
+    profiler.register(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -8,6 +8,13 @@ from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from app.models import User
 from app.auth.email import send_password_reset_email
+from app.passwords import PasswordHasherBusy
+
+
+@bp.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error): # the hashing pool is backed up, let the user try again instead of a 500
+    flash(_('The server is busy right now, please try again in a moment.'))
+    return redirect(request.url)
 
 
 @bp.route('/login', methods=['GET', 'POST'])
@@ -20,6 +27,12 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
+        if user.password_needs_rehash(): # the password is known right now, so upgrade the stored hash
+            try:
+                user.set_password(form.password.data)
+                db.session.commit()
+            except PasswordHasherBusy: # the next login upgrades it
+                pass
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
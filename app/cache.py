@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# small in-process LRU cache with an optional time-to-live, shared by the caches hung off the app object
+# in create_app(). every cache keeps hit/miss counters so they can be checked from `flask shell`.
+# with weigh= and maxweight= it is also bounded by the total weight of its values, e.g. bytes of html.
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None, weigh=None, maxweight=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.maxweight = maxweight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (expires, value), oldest first
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (expires, value)
+            if self.weigh:
+                self.weight += self.weigh(value)
+            while len(self._data) > self.maxsize or \
+                    (self.maxweight and self.weight > self.maxweight and self._data):
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key): # callers hold the lock
+        entry = self._data.pop(key, None)
+        if entry is not None and self.weigh:
+            self.weight -= self.weigh(entry[1])
+        return entry
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._discard(key)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'weight': self.weight, 'hits': self.hits, 'misses': self.misses}
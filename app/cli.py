@@ -0,0 +1,78 @@
+import click
+from app import db
+
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """Materialized home timeline commands."""
+        pass
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild every user's home timeline from the followers table."""
+        from app.models import User
+        from app import timeline as timelines
+        for user in User.query.all():
+            timelines.rebuild(user)
+            db.session.commit()
+
+    @timeline.command()
+    def trim():
+        """Drop timeline rows beyond TIMELINE_MAX_LENGTH."""
+        from app.models import User
+        from app import timeline as timelines
+        for user in User.query:
+            timelines.trim(user.id)
+        db.session.commit()
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--chunk-size', default=1000, help='Rows per bulk request.')
+    @click.option('--workers', default=4, help='Bulk requests sent in parallel.')
+    @click.option('--resume', is_flag=True,
+                  help='Continue after the last id a previous run indexed.')
+    def reindex(chunk_size, workers, resume):
+        """Rebuild the posts index from the database."""
+        from app.models import Post
+
+        def progress(sent, elapsed):
+            click.echo('{} posts indexed, {:.0f} posts/s'.format(
+                sent, sent / elapsed if elapsed else 0))
+
+        sent = Post.reindex(chunk_size=chunk_size, workers=workers,
+                            resume=resume, progress=progress)
+        click.echo('Done, {} posts indexed.'.format(sent))
+
+    @app.cli.group()
+    def language():
+        """Post language detection commands."""
+        pass
+
+    @language.command()
+    @click.option('--chunk-size', default=1000, help='Posts per commit.')
+    @click.option('--workers', default=None, type=int,
+                  help='Detector processes, one per CPU by default.')
+    def backfill(chunk_size, workers):
+        """Detect the language of posts that don't have one yet."""
+        from app.language import backfill as backfill_languages
+        done = backfill_languages(chunk_size=chunk_size, workers=workers,
+                                  progress=lambda done: click.echo(
+                                      '{} posts detected'.format(done)))
+        click.echo('Done, {} posts detected.'.format(done))
+
+    @app.cli.group()
+    def profile():
+        """Request profiling commands."""
+        pass
+
+    @profile.command()
+    @click.option('--expires-in', default=3600, help='Seconds the token is valid.')
+    def token(expires_in):
+        """Print an X-Profile header value that profiles a request."""
+        from app.profiler import profile_token
+        click.echo(profile_token(app.config['SECRET_KEY'], expires_in))
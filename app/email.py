@@ -1,17 +1,128 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+from threading import Thread, Lock
+from time import sleep
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailPool(object):
+    # fixed number of worker threads fed by a bounded queue. each worker keeps its SMTP connection open while
+    # there is mail to send, takes up to MAIL_BATCH_SIZE messages at a time off the queue and closes the
+    # connection after MAIL_IDLE_TIMEOUT seconds without mail. transient failures (dropped connections, 4xx
+    # replies) reconnect and retry with backoff. when the queue is full send() blocks for up to
+    # MAIL_ENQUEUE_TIMEOUT seconds, so a reset storm slows the senders down instead of piling up threads.
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.enqueue_timeout = app.config['MAIL_ENQUEUE_TIMEOUT']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.sent = 0
+        self.failed = 0
+        self._threads = []
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = Thread(target=self._run, name='mail-{}'.format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def send(self, msg):
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.app.logger.error('Mail queue is full, dropped "%s" to %s',
+                                  msg.subject, msg.recipients)
+            return False
+        return True
+
+    def join(self): # blocks until every queued message has been handled
+        self.queue.join()
+
+    def shutdown(self, timeout=10): # sends what is still queued, then stops the workers
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            connection = None
+            while True:
+                try:
+                    msg = self.queue.get(timeout=self.idle_timeout if connection else None)
+                except queue.Empty: # idle, let the server have its connection back
+                    connection = self._close(connection)
+                    continue
+                batch = [msg]
+                while msg is not None and len(batch) < self.batch_size:
+                    try:
+                        msg = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(msg)
+                for msg in batch:
+                    if msg is not None:
+                        connection = self._deliver(connection, msg)
+                    self.queue.task_done()
+                if None in batch:
+                    self._close(connection)
+                    return
+
+    def _deliver(self, connection, msg):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                connection.send(msg)
+                self.sent += 1
+                return connection
+            except smtplib.SMTPResponseException as e:
+                error = e
+                if not 400 <= e.smtp_code < 500: # permanent, retrying won't help
+                    break
+            except smtplib.SMTPServerDisconnected as e:
+                error = e
+            except smtplib.SMTPException as e: # refused recipients and the like
+                error = e
+                break
+            except OSError as e: # socket errors, SMTPException is an OSError too so it has to come first
+                error = e
+            except Exception as e: # bad headers, missing sender, keep the worker alive
+                error = e
+                break
+            connection = self._close(connection)
+            if attempt < self.max_retries:
+                sleep(min(2 ** attempt * 0.1, 5))
+        self.failed += 1
+        self.app.logger.error('Could not send "%s" to %s: %s', msg.subject,
+                              msg.recipients, error)
+        return connection
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    return current_app.mail_pool.send(msg)
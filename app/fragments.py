@@ -0,0 +1,45 @@
+from flask import current_app, g, render_template, Markup
+from app import db
+
+# cache of rendered _post.html fragments. an entry is stored under (post id, locale) together with the
+# version it was rendered with: the author's username and avatar hash and the post's language and body, all
+# read from rows the page has loaded anyway. the body is 140 characters at most and compared as it is, so
+# rendering a page does no hashing. so a renamed user, an edited post or a language detected later
+# re-renders on the next view, also when another worker made the change. posts changed or deleted in a
+# commit are dropped from this worker's cache right away by invalidate_posts(). the cache is bounded by
+# FRAGMENT_CACHE_BYTES of html, least recently used first.
+
+
+def render_post(post): # used as {{ render_post(post) }} in place of {% include '_post.html' %}
+    cache = current_app.fragment_cache
+    key = (post.id, g.locale)
+    version = (post.author.username, post.author.avatar_hash, post.language, post.body)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    html = Markup(render_template('_post.html', post=post))
+    cache.set(key, (version, html))
+    return html
+
+
+def record_changed_posts(session, flush_context):
+    from app.models import Post
+    changed = session.info.setdefault('changed_posts', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Post):
+            changed.add(obj.id)
+
+
+def invalidate_posts(session):
+    for id in session.info.pop('changed_posts', ()):
+        for locale in current_app.config['LANGUAGES']:
+            current_app.fragment_cache.pop((id, locale))
+
+
+def discard_changed_posts(session, previous_transaction):
+    session.info.pop('changed_posts', None)
+
+
+db.event.listen(db.session, 'after_flush', record_changed_posts)
+db.event.listen(db.session, 'after_commit', invalidate_posts)
+db.event.listen(db.session, 'after_soft_rollback', discard_changed_posts)
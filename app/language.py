@@ -0,0 +1,126 @@
+import atexit
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from threading import Thread, Lock
+from time import sleep
+from flask import current_app
+from guess_language import guess_language
+from app import db
+
+# language detection for new posts, off the request path. index() saves the post with language NULL and
+# hands the text to a process pool (guess_language is pure python, so threads would just fight over the
+# GIL), a writer thread collects the answers and stores them with one executemany UPDATE per batch.
+# LANGUAGE_WORKERS = 0 detects inline instead, like before.
+
+
+@lru_cache(maxsize=4096)
+def detect(text):
+    language = guess_language(text)
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    return language
+
+
+def save_languages(app, languages): # {post id: language}, also drops the cached fragments rendered without it
+    from app.models import Post
+    table = Post.__table__
+    stmt = table.update().where(table.c.id == db.bindparam('post_id')).values(
+        language=db.bindparam('detected'))
+    with db.engine.begin() as connection:
+        connection.execute(stmt, [{'post_id': id, 'detected': language}
+                                  for id, language in languages.items()])
+    for id in languages:
+        for locale in app.config['LANGUAGES']:
+            app.fragment_cache.pop((id, locale))
+
+
+class LanguageDetector(object):
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['LANGUAGE_WORKERS']
+        self.batch_size = app.config['LANGUAGE_BATCH_SIZE']
+        self._pool = None
+        self._results = queue.Queue()
+        self._writer = None
+        self._pending = 0
+        self._lock = Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._writer = Thread(target=self._write, name='language-writer', daemon=True)
+                self._writer.start()
+                atexit.register(self.shutdown)
+
+    def submit(self, post):
+        if self.workers <= 0:
+            save_languages(self.app, {post.id: detect(post.body)})
+            return
+        self._start()
+        with self._lock:
+            self._pending += 1
+        id = post.id
+        future = self._pool.submit(detect, post.body)
+        future.add_done_callback(lambda f: self._results.put((id, f)))
+
+    def join(self): # blocks until every submitted post has its language stored, for tests
+        while True:
+            with self._lock:
+                if self._pending == 0:
+                    return
+            sleep(0.01)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self.join()
+
+    def _write(self):
+        with self.app.app_context():
+            while True:
+                batch = [self._results.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._results.get_nowait())
+                    except queue.Empty:
+                        break
+                languages = {}
+                for id, future in batch:
+                    try:
+                        languages[id] = future.result()
+                    except Exception as e:
+                        self.app.logger.error('Language detection failed for post %s: %s', id, e)
+                try:
+                    if languages:
+                        save_languages(self.app, languages)
+                except Exception as e:
+                    self.app.logger.error('Could not store post languages: %s', e)
+                with self._lock:
+                    self._pending -= len(batch)
+                for item in batch:
+                    self._results.task_done()
+
+
+def backfill(chunk_size=1000, workers=None, progress=None):
+    # detects every post whose language is still NULL, chunk by chunk in id order, in parallel across a
+    # process pool, and commits each chunk before reading the next
+    from app.models import Post
+    app = current_app._get_current_object()
+    done = 0
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = db.session.query(Post.id, Post.body).filter(
+                Post.language.is_(None), Post.id > last_id).order_by(
+                    Post.id).limit(chunk_size).all()
+            if not rows:
+                return done
+            last_id = rows[-1][0]
+            languages = pool.map(detect, [row[1] or '' for row in rows],
+                                 chunksize=max(1, len(rows) // (4 * (workers or 4))))
+            save_languages(app, dict(zip([row[0] for row in rows], languages)))
+            done += len(rows)
+            if progress:
+                progress(done)
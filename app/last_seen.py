@@ -0,0 +1,89 @@
+import atexit
+import weakref
+from datetime import datetime, timedelta
+from threading import Thread, Lock, Event
+from time import monotonic
+from app import db
+
+# coalesces the last_seen bumps from before_request. instead of a commit on every authenticated request,
+# timestamps are buffered per user and written with one executemany UPDATE every LAST_SEEN_FLUSH_INTERVAL
+# seconds or LAST_SEEN_FLUSH_USERS users, whichever comes first. a user whose stored last_seen is newer
+# than LAST_SEEN_GRANULARITY seconds isn't buffered at all. a timer thread does the interval flushes, so a
+# quiet site doesn't keep timestamps in memory until the next request (the test app flushes on requests).
+# stop() ends the timer and writes what is left, it runs for every buffer still around at exit.
+
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_all():
+    for buffer in list(_buffers):
+        buffer.stop()
+
+
+class LastSeenBuffer(object):
+    def __init__(self, app):
+        self.app = app
+        self.granularity = timedelta(seconds=app.config['LAST_SEEN_GRANULARITY'])
+        self.interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self.max_users = app.config['LAST_SEEN_FLUSH_USERS']
+        self._pending = {} # user id -> datetime
+        self._lock = Lock()
+        self._last_flush = monotonic()
+        self._timer = None
+        self._stopped = Event()
+        _buffers.add(self)
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        if user.last_seen is not None and now - user.last_seen < self.granularity:
+            return
+        with self._lock:
+            seen = self._pending.get(user.id)
+            if seen is None or now - seen >= self.granularity:
+                self._pending[user.id] = now
+            due = len(self._pending) >= self.max_users or \
+                monotonic() - self._last_flush >= self.interval
+        if due:
+            self.flush()
+        elif not self.app.testing:
+            self._start_timer()
+
+    def _start_timer(self):
+        if self._timer is None:
+            with self._lock:
+                if self._timer is None:
+                    self._timer = Thread(target=self._run, name='last-seen', daemon=True)
+                    self._timer.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                self.app.logger.error('Could not store last seen times: %s', e)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = monotonic()
+        if not pending:
+            return 0
+        from app.models import User
+        table = User.__table__
+        stmt = table.update().where(table.c.id == db.bindparam('user_id')).values(
+            last_seen=db.bindparam('seen'))
+        with db.engine.begin() as connection: # own transaction, the request's session is left alone
+            connection.execute(stmt, [{'user_id': id, 'seen': seen}
+                                      for id, seen in pending.items()])
+        for id in pending: # the cached copies still have the old last_seen
+            self.app.user_cache.pop(id)
+        return len(pending)
+
+    def stop(self):
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.join()
+        with self.app.app_context():
+            self.flush()
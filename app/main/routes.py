@@ -1,21 +1,21 @@
-from datetime import datetime
+from hmac import compare_digest
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 from app import db
 from app.main.forms import EditProfileForm, PostForm, SearchForm
-from app.models import User, Post
-from app.translate import translate
+from app.models import User, Post, eager_load
+from app.translate import translate, translate_groups
+from app.pagination import paginate
+from app.replicas import read_only
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user) # buffered, written in batches by app/last_seen.py
         g.search_form = SearchForm() # create an instance of search form when current user is authenticated.
         # Stored in g container. This g variable provided by Flask is a place where the application 
         # can store data that needs to persist through the life of a request
@@ -26,60 +26,70 @@ def before_request():
     g.locale = str(get_locale())
 
 
+def paginate_posts(query, endpoint, keyset=None, **kwargs):
+    # keyset pages (?before= / ?after= cursors) by default, ?page= offset pages still work for old links.
+    # keyset(per_page, before, after) builds the keyset page when the listing has its own way of reading it
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        posts = query.paginate(page, per_page, False)
+        next_url = url_for(endpoint, page=posts.next_num, **kwargs) \
+            if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **kwargs) \
+            if posts.has_prev else None
+        return posts.items, next_url, prev_url
+    if keyset is None:
+        keyset = lambda per_page, before, after: paginate(query, Post, per_page, before, after)
+    posts = keyset(per_page, request.args.get('before'), request.args.get('after'))
+    next_url = url_for(endpoint, before=posts.next_cursor, **kwargs) \
+        if posts.next_cursor else None
+    prev_url = url_for(endpoint, after=posts.prev_cursor, **kwargs) \
+        if posts.prev_cursor else None
+    return posts.items, next_url, prev_url
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@read_only
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        current_app.language_detector.submit(post) # fills in post.language in the background, see app/language.py
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_posts(
+        current_user.home_timeline(), 'main.index',
+        keyset=current_user.home_page)
     return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
 @bp.route('/explore')
 @login_required
+@read_only
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_posts(
+        Post.query.options(eager_load(Post.author)).order_by(Post.timestamp.desc()),
+        'main.explore')
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
 @bp.route('/user/<username>')
 @login_required
+@read_only
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
-    return render_template('user.html', user=user, posts=posts.items,
+    posts, next_url, prev_url = paginate_posts(
+        user.posts.options(eager_load(Post.author)).order_by(Post.timestamp.desc()), 'main.user',
+        username=user.username)
+    return render_template('user.html', user=user, posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -139,15 +149,66 @@ def translate_text():
                                       request.form['source_language'],
                                       request.form['dest_language'])})
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    # {"items": [{"post_id": 1, "source_language": "es", "dest_language": "en"}, ...]} -> {"translations": {"1": "..."}}
+    # the texts come from the database, each language pair is one upstream request and the pairs run concurrently.
+    # only the first POSTS_PER_PAGE items are translated (one page of posts), the rest are ignored. items that
+    # aren't objects, whose post_id isn't a number or that lack a language are skipped, a body without an
+    # "items" list is a 400.
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return jsonify({'error': 'expected {"items": [...]}'}), 400
+    wanted = [] # (post id, (source, dest))
+    for item in items[:current_app.config['POSTS_PER_PAGE']]:
+        if not isinstance(item, dict):
+            continue
+        try:
+            id = int(item.get('post_id'))
+        except (TypeError, ValueError):
+            continue
+        source, dest = item.get('source_language'), item.get('dest_language')
+        if not source or not dest:
+            continue
+        wanted.append((id, (str(source), str(dest))))
+    ids = [id for id, pair in wanted]
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids))} if ids else {}
+    groups = {}
+    for id, pair in wanted:
+        if id in posts:
+            groups.setdefault(pair, []).append(posts[id])
+    results = translate_groups({pair: [post.body for post in group]
+                                for pair, group in groups.items()})
+    translations = {}
+    for pair, group in groups.items():
+        for post, text in zip(group, results[pair]):
+            translations[str(post.id)] = text
+    return jsonify({'translations': translations})
+
 @bp.route('/search')
 @login_required
+@read_only
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
+    # search results are ranked by relevance, not time, so they keep page numbers
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form/q/data, page=page - 1) \
+    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
         if page > 1 else None
-    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
\ No newline at end of file
+    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/metrics')
+def metrics():
+    # prometheus text format, for the ADMINS or a scraper sending "Authorization: Bearer <METRICS_TOKEN>"
+    token = current_app.config['METRICS_TOKEN']
+    sent = request.headers.get('Authorization', '')
+    if not (token and compare_digest(sent, 'Bearer ' + token)) and not (
+            current_user.is_authenticated and current_user.email in current_app.config['ADMINS']):
+        abort(404)
+    return current_app.metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
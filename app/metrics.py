@@ -0,0 +1,167 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from flask import g, request, has_request_context
+
+# per-endpoint histograms of request latency and of the time spent in the database, the search backend and the
+# translator, served in prometheus text format by /metrics. every thread records into its own shard, so the
+# request path takes no lock, /metrics adds the shards up when it is scraped. shards of threads that have
+# exited (flask run starts one per connection) are folded into a base shard then, so their number stays at
+# the number of live threads.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+HISTOGRAMS = [
+    ('microblog_request_duration_seconds', 'Request latency by endpoint.'),
+    ('microblog_db_duration_seconds', 'Time spent in SQL per request.'),
+    ('microblog_search_duration_seconds', 'Time spent in the search backend per request.'),
+    ('microblog_translator_duration_seconds', 'Time spent waiting for the translator per request.'),
+]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.sum += other.sum
+        self.count += other.count
+
+
+class Metrics(object):
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+        self._shards = {} # thread -> (histograms, responses), for every thread that served a request
+        self._base = ({}, {}) # what exited threads recorded
+        self._lock = threading.Lock() # only taken the first time a thread records something, and by collect()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards[threading.current_thread()] = shard
+        return shard
+
+    def observe(self, name, endpoint, value):
+        histograms = self._shard()[0]
+        histogram = histograms.get((name, endpoint))
+        if histogram is None:
+            histogram = histograms[(name, endpoint)] = Histogram()
+        histogram.observe(value)
+
+    def count_response(self, endpoint, status):
+        responses = self._shard()[1]
+        key = (endpoint, status)
+        responses[key] = responses.get(key, 0) + 1
+
+    @staticmethod
+    def _add(into, shard):
+        histograms, responses = into
+        for key, histogram in list(shard[0].items()):
+            histograms.setdefault(key, Histogram()).merge(histogram)
+        for key, count in list(shard[1].items()):
+            responses[key] = responses.get(key, 0) + count
+
+    def collect(self): # the shards added up: ({(name, endpoint): Histogram}, {(endpoint, status): count})
+        with self._lock:
+            for thread in [thread for thread in self._shards if not thread.is_alive()]:
+                self._add(self._base, self._shards.pop(thread)) # nothing writes to it any more
+            shards = list(self._shards.values())
+            total = ({}, {})
+            self._add(total, self._base)
+        for shard in shards:
+            self._add(total, shard)
+        return total
+
+    def render(self):
+        histograms, responses = self.collect()
+        lines = []
+        for name, help in HISTOGRAMS:
+            lines += ['# HELP {} {}'.format(name, help), '# TYPE {} histogram'.format(name)]
+            for (metric, endpoint), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                total = 0
+                for le, n in zip([str(b) for b in BUCKETS] + ['+Inf'], histogram.buckets):
+                    total += n
+                    lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(name, endpoint, le, total))
+                lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, histogram.sum))
+                lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, histogram.count))
+        lines += ['# HELP microblog_responses_total Responses by endpoint and status code.',
+                  '# TYPE microblog_responses_total counter']
+        for (endpoint, status), count in sorted(responses.items()):
+            lines.append('microblog_responses_total{{endpoint="{}",status="{}"}} {}'.format(
+                endpoint, status, count))
+        lines += self._gauges()
+        return '\n'.join(lines) + '\n'
+
+    def _gauges(self): # the numbers the other parts of the app already keep
+        app = self.app
+        breaker = app.translator_breaker.stats()
+        lines = ['# TYPE microblog_translator_breaker_open gauge',
+                 'microblog_translator_breaker_open {}'.format(int(breaker['state'] != 'closed')),
+                 '# TYPE microblog_translator_breaker_trips_total counter',
+                 'microblog_translator_breaker_trips_total {}'.format(breaker['trips'])]
+        caches = {'follow_graph': app.follow_graph.stats(), 'user': app.user_cache.stats(),
+                  'fragment': app.fragment_cache.stats(), 'search': app.search_cache.stats(),
+                  'translation': app.translation_cache.memory.stats()}
+        for stat, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+            name = 'microblog_cache_{}'.format(stat) + ('_total' if kind == 'counter' else '')
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for cache, stats in sorted(caches.items()):
+                lines.append('{}{{cache="{}"}} {}'.format(name, cache, stats[stat]))
+        lines += ['# TYPE microblog_mail_sent_total counter',
+                  'microblog_mail_sent_total {}'.format(app.mail_pool.sent),
+                  '# TYPE microblog_mail_failed_total counter',
+                  'microblog_mail_failed_total {}'.format(app.mail_pool.failed)]
+        return lines
+
+
+@contextmanager
+def timed(name): # adds the time spent in the block to this request's 'search' or 'translator' total
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            times = g.setdefault('metric_times', {})
+            times[name] = times.get(name, 0) + perf_counter() - start
+
+
+def register(app):
+    app.metrics = Metrics(app)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        endpoint = request.endpoint or 'none'
+        metrics = app.metrics
+        metrics.observe('microblog_request_duration_seconds', endpoint, perf_counter() - start)
+        queries = g.get('sql') # from app/sql_stats.py
+        if queries is not None:
+            metrics.observe('microblog_db_duration_seconds', endpoint, queries.time)
+        times = g.get('metric_times', {})
+        if 'search' in times:
+            metrics.observe('microblog_search_duration_seconds', endpoint, times['search'])
+        if 'translator' in times:
+            metrics.observe('microblog_translator_duration_seconds', endpoint, times['translator'])
+        metrics.count_response(endpoint, response.status_code)
+        return response
@@ -1,12 +1,24 @@
 from datetime import datetime
 from hashlib import md5
-from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import time, monotonic
 from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import bulk_index, query_index, document
+from app import timeline as timelines
+from app.pagination import paginate
+
+def eager_load(relationship): # loader option for a relationship every row of a listing needs, see POST_AUTHOR_LOADING
+    if current_app.config['POST_AUTHOR_LOADING'] == 'selectin':
+        return db.selectinload(relationship)
+    return db.joinedload(relationship)
+
 
 # designed to be used as a subclass of Post, so it can be easily extracted and used in other apps.
 class SearchableMixin(object):
@@ -16,13 +28,14 @@ class SearchableMixin(object):
         # calls query_index() with cls.__tablename__ to use SQLAlchemy table names as index names in Elastic
         ids, total = query_index(cls.__tablename__, expression, page, per_page) #cls used instead of self because this method recieves a class, not an instance of it's first arg.
         if total == 0:                                    # for instance, once Post class is attached to search() as Post.search() we don't need to have an instance of the Post class
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
-        # The search() function returns the query that replaces the list of IDs, and also passes through the total number of search results as a second return value.
-        # SQLAlchemy query using SQL CASE statement so results return in the order that Elastic returns.
+            return [], 0
+        # one IN query, with the relationships named in __searchable_load__ (Post.author) loaded in the same round trip.
+        # the rows come back in whatever order the database likes and are put back in search rank order here,
+        # ids the index still has but the database no longer does are skipped.
+        options = [eager_load(getattr(cls, name)) for name in getattr(cls, '__searchable_load__', ())]
+        found = {obj.id: obj for obj in cls.query.options(*options).filter(cls.id.in_(ids))}
+        return [found[id] for id in ids if id in found], total
+        # The search() function returns the list of objects for the IDs, and also passes through the total number of search results as a second return value.
     @classmethod
     def before_commit(cls, session): # triggered before a commit
         session._changes = { # session._changes dicitonary to write these objects in a place that is going to survive after the commit. need them to update Elasticsearch index
@@ -33,40 +46,114 @@ class SearchableMixin(object):
 
     @classmethod
     def after_commit(cls, session): # uses objects in before_commit to update Elasticsearch index
+        if not current_app.search_backend.enabled:
+            session._changes = None
+            return
+        queue = current_app.search_queue # changes are queued and sent in bulk by a background worker, see app/search_queue.py
+        changed = set() # indexes whose cached search results are now out of date
         for obj in session._changes['add']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                queue.add(obj.__tablename__, obj.id, document(obj))
+                changed.add(obj.__tablename__)
         for obj in session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                queue.add(obj.__tablename__, obj.id, document(obj))
+                changed.add(obj.__tablename__)
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                queue.remove(obj.__tablename__, obj.id)
+                changed.add(obj.__tablename__)
+        for index in changed:
+            current_app.search_cache.invalidate(index)
         session._changes = None
     
     @classmethod
-    def reindex(cls): # refreshes the Elasticsearch index with all data from relational side.
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, chunk_size=1000, workers=1, resume=False, progress=None): # refreshes the Elasticsearch index with all data from relational side.
+        # rows are read in id order in keyset chunks of plain column tuples (no ORM objects) and each chunk is
+        # one _bulk request. with workers > 1 the requests are sent from a thread pool while the next chunks are
+        # read. the checkpoint only moves past a chunk once it and every chunk before it are sent, so resume=True
+        # picks up after the last fully indexed id. progress(sent, elapsed) is called after each chunk.
+        index = cls.__tablename__
+        queue = current_app.search_queue
+        app = current_app._get_current_object()
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        last_id = queue.checkpoint(index) if resume else 0
+
+        def send(documents):
+            with app.app_context():
+                bulk_index(index, documents, ())
+
+        sent = 0
+        start = monotonic()
+        in_flight = deque() # (future, last id of the chunk, rows in the chunk), oldest first
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                rows = db.session.query(cls.id, *columns).filter(
+                    cls.id > last_id).order_by(cls.id).limit(chunk_size).all()
+                if rows:
+                    last_id = rows[-1][0]
+                    documents = {row[0]: dict(zip(cls.__searchable__, row[1:])) for row in rows}
+                    in_flight.append((pool.submit(send, documents), last_id, len(rows)))
+                while in_flight and (not rows or len(in_flight) > workers or in_flight[0][0].done()):
+                    future, done_id, count = in_flight.popleft()
+                    future.result() # re-raises, leaving the checkpoint at the last good chunk
+                    queue.set_checkpoint(index, done_id)
+                    sent += count
+                    if progress:
+                        progress(sent, monotonic() - start)
+                if not rows:
+                    break
+        return sent
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit) # SQLAlchemy functions. event listeners that call before/after_commit functions at the right times.
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit) # will need this later <-------- !
 
+
+def invalidate_follow_graph(session, *args): # follow()/unfollow() drop their user again once the change commits or rolls back
+    for user_id in session.info.pop('follow_graph_changed', ()):
+        current_app.follow_graph.pop(user_id)
+
+db.event.listen(db.session, 'after_commit', invalidate_follow_graph)
+db.event.listen(db.session, 'after_soft_rollback', invalidate_follow_graph)
+
+# composite primary key rejects duplicate edges and serves "who do I follow", the reverse index serves "who follows me"
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
+# materialized home timelines, see app/timeline.py. timestamp is copied from the post so the slice can be read in order from the index
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id')
+)
+
+
+def gravatar_hash(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def gravatar_url(digest, size):
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+        digest, size)
+
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
-    posts = db.relationship('Post', backref='author', lazy='dynamic')
+    posts = db.relationship('Post', backref='author', lazy='dynamic') # post lists load the authors with eager_load()
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    avatar_hash = db.Column(db.String(32)) # md5 of the lowercased email, set by validate_email()
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False) # kept by follow()/unfollow(), decides fan-out
     followed = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -76,35 +163,86 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+    def set_password(self, password): # hashing runs in the PasswordHasher process pool, see app/passwords.py
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return current_app.password_hasher.check(self.password_hash, password)
+
+    def password_needs_rehash(self): # stored with an older PASSWORD_HASH_METHOD
+        return current_app.password_hasher.needs_rehash(self.password_hash)
+
+    @db.validates('email')
+    def validate_email(self, key, email): # the gravatar digest is worked out once here instead of on every avatar() call
+        self.avatar_hash = gravatar_hash(email) if email else None
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        return gravatar_url(self.avatar_hash or gravatar_hash(self.email), size)
 
-    def follow(self, user):
-        if not self.is_following(user):
+    def follow(self, user): # checked against the database, another worker may have changed the edge since the cache loaded
+        if not self.follows_in_db(user):
             self.followed.append(user)
+            self._follow_graph_changed()
+            self._count_follower(user, 1)
+            if timelines.enabled():
+                timelines.backfill(self, user)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self.follows_in_db(user):
             self.followed.remove(user)
+            self._follow_graph_changed()
+            count = self._count_follower(user, -1)
+            if timelines.enabled():
+                timelines.remove_author(self, user)
+                if count == current_app.config['TIMELINE_FANOUT_LIMIT']: # fanned out again from now on
+                    timelines.demoted(user)
 
-    def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+    def _count_follower(self, user, delta): # follower_count is updated in sql so concurrent follows don't lose counts
+        if user.id is None: # not flushed yet, it needs an id to be counted
+            db.session.flush()
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == user.id).values(
+            follower_count=table.c.follower_count + delta))
+        db.session.expire(user, ['follower_count'])
+        return user.follower_count
+
+    def is_following(self, user): # answered from the follow graph cache, no query once the set is loaded
+        return user.id in self.followed_ids()
+
+    def follows_in_db(self, user): # EXISTS stops at the first primary key hit, for decisions that write
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).scalar()
+
+    def followed_ids(self): # frozenset of the ids this user follows, loaded with one indexed query on a cache miss
+        return current_app.follow_graph.get_or_load(self.id, self._load_followed_ids)
+
+    def _follow_graph_changed(self):
+        current_app.follow_graph.pop(self.id)
+        db.session.info.setdefault('follow_graph_changed', set()).add(self.id)
+
+    def _load_followed_ids(self):
+        rows = db.session.execute(db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == self.id))
+        return frozenset(row[0] for row in rows)
 
     def followed_posts(self):
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
                 followers.c.follower_id == self.id)
         own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return followed.union(own).options(eager_load(Post.author)).order_by(Post.timestamp.desc())
+
+    def home_timeline(self): # reads the materialized timeline when TIMELINE_ENABLED, otherwise the fan-out-on-read query above
+        if timelines.enabled():
+            return timelines.home_timeline(self)
+        return self.followed_posts()
+
+    def home_page(self, per_page, before=None, after=None): # one keyset page of the above, see app/pagination.py
+        if timelines.enabled():
+            return timelines.home_page(self, per_page, before, after)
+        return paginate(self.followed_posts(), Post, per_page, before, after)
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -124,10 +262,49 @@ class User(UserMixin, db.Model):
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # the user's column values are cached for USER_CACHE_TTL seconds, so an authenticated request doesn't start
+    # with a query. a hit is rebuilt as a detached User and merged into the session without touching the database.
+    id = int(id)
+    values = current_app.user_cache.get(id)
+    if values is None:
+        user = User.query.get(id)
+        if user is not None:
+            current_app.user_cache.set(id, {key: getattr(user, key) for key in user_columns()})
+        return user
+    user = User()
+    for key, value in values.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def user_columns():
+    return [attr.key for attr in db.inspect(User).column_attrs]
+
+
+def users_changed(session, flush_context, instances): # profile, email and password changes drop the cached user
+    changed = session.info.setdefault('users_changed', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            current_app.user_cache.pop(obj.id)
+            changed.add(obj.id)
+
+
+def invalidate_users(session, *args): # and again once the change commits or rolls back, in case a request cached it meanwhile
+    for user_id in session.info.pop('users_changed', ()):
+        current_app.user_cache.pop(user_id)
+
+db.event.listen(db.session, 'before_flush', users_changed)
+db.event.listen(db.session, 'after_commit', invalidate_users)
+db.event.listen(db.session, 'after_soft_rollback', invalidate_users)
 
 class Post(SearchableMixin, db.Model): # add SearchableMixin class as subclass in Post
     __searchable__ = ['body']
+    __searchable_load__ = ['author'] # eager loaded by SearchableMixin.search() so the results page doesn't lazy load each author
+    __table_args__ = ( # composite indexes for the (timestamp, id) keyset pagination in app/pagination.py
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -136,3 +313,6 @@ class Post(SearchableMixin, db.Model): # add SearchableMixin class as subclass i
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+db.event.listen(db.session, 'before_flush', timelines.before_flush)
+db.event.listen(db.session, 'after_flush', timelines.after_flush) # fan out new posts into follower timelines in the same transaction
@@ -0,0 +1,71 @@
+import base64
+from datetime import datetime
+from app import db
+
+# keyset (cursor) pagination over post listings. instead of LIMIT/OFFSET each page continues from the
+# (timestamp, id) of the last post shown, so deep pages cost the same as the first one and don't shift
+# when new posts arrive. cursors are opaque url-safe tokens used as ?before= (older) and ?after= (newer).
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(post):
+    raw = '{}|{}'.format(post.timestamp.strftime(TIMESTAMP_FORMAT), post.id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class KeysetPage(object):
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = encode_cursor(items[-1]) if has_next and items else None
+        self.prev_cursor = encode_cursor(items[0]) if has_prev and items else None
+
+
+def keyset_filter(timestamp, id, cursor, newer): # rows past the cursor, for any (timestamp, id) column pair
+    at, last = cursor
+    if newer:
+        return db.or_(timestamp > at, db.and_(timestamp == at, id > last))
+    return db.or_(timestamp < at, db.and_(timestamp == at, id < last))
+
+
+def keyset_order(timestamp, id, newer):
+    return (timestamp.asc(), id.asc()) if newer else (timestamp.desc(), id.desc())
+
+
+def keyset_page(items, per_page, newer, has_cursor):
+    # items are up to per_page + 1 rows read away from the cursor, oldest first when paging to newer posts
+    if newer:
+        return KeysetPage(list(reversed(items[:per_page])), has_next=True,
+                          has_prev=len(items) > per_page)
+    return KeysetPage(items[:per_page], has_next=len(items) > per_page,
+                      has_prev=has_cursor)
+
+
+def parse_cursors(before=None, after=None): # (cursor, newer), cursor is None on the first page or a bad token
+    if after:
+        cursor = decode_cursor(after)
+        if cursor is not None:
+            return cursor, True
+    return (decode_cursor(before) if before else None), False
+
+
+def paginate(query, model, per_page, before=None, after=None):
+    # query is any Post listing, its own ORDER BY is replaced by (timestamp, id) so the cursor is unique
+    query = query.order_by(None)
+    cursor, newer = parse_cursors(before, after)
+    if cursor is not None:
+        query = query.filter(keyset_filter(model.timestamp, model.id, cursor, newer))
+    items = query.order_by(*keyset_order(model.timestamp, model.id, newer)).limit(
+        per_page + 1).all()
+    return keyset_page(items, per_page, newer, cursor is not None)
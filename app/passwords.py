@@ -0,0 +1,66 @@
+import atexit
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import Lock, BoundedSemaphore
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+
+# password hashing in a process pool, so a login spike burns CPU in PASSWORD_HASH_WORKERS processes instead
+# of holding the request workers (and the GIL) for the whole PBKDF2 run. the request thread only waits on
+# the result. PASSWORD_HASH_METHOD is a werkzeug method string, e.g. pbkdf2:sha256:260000, stored hashes made
+# with different parameters are reported by needs_rehash() and upgraded on the next successful login.
+# at most PASSWORD_HASH_MAX_PENDING hashes are queued or running at once, a request that can't get a slot or
+# whose hash doesn't finish within PASSWORD_HASH_TIMEOUT gets PasswordHasherBusy instead of piling more work
+# on the pool. PASSWORD_HASH_WORKERS = 0 hashes inline.
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def normalize_method(method):
+    if method.startswith('pbkdf2:') and method.count(':') == 1: # werkzeug adds its default iteration count
+        method += ':{}'.format(DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+class PasswordHasher(object):
+    def __init__(self, app):
+        self.method = normalize_method(app.config['PASSWORD_HASH_METHOD'])
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self._pending = BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+        self._pool = None
+        self._lock = Lock()
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                atexit.register(self._pool.shutdown)
+        if not self._pending.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._pending.release()
+            raise
+        # the slot is given back when the hash is done or cancelled, not when this request stops waiting
+        future.add_done_callback(lambda future: self._pending.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel() # still queued: drop it. already running: it finishes, the result is thrown away
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return not pwhash or pwhash.split('$', 1)[0] != self.method
@@ -0,0 +1,70 @@
+import cProfile
+import os
+import random
+import re
+from time import time, perf_counter
+import jwt
+from flask import g, request
+
+# opt-in profiling of production requests. with PROFILE_ENABLED set, PROFILE_SAMPLE_RATE of the requests, and
+# every request with a valid X-Profile token (see `flask profile token`), run under cProfile. each profile is
+# saved in PROFILE_DIR as a .pstats file named after the time, endpoint and duration, which snakeviz,
+# flameprof or gprof2dot can read. the oldest files are deleted once there are more than PROFILE_MAX_FILES
+# or they take more than PROFILE_MAX_BYTES. without PROFILE_ENABLED no hooks are installed at all.
+
+
+def profile_token(secret_key, expires_in=3600):
+    return jwt.encode({'profile': True, 'exp': time() + expires_in},
+                      secret_key, algorithm='HS256').decode('utf-8')
+
+
+def valid_token(token, secret_key):
+    try:
+        return jwt.decode(token, secret_key, algorithms=['HS256']).get('profile') is True
+    except jwt.InvalidTokenError:
+        return False
+
+
+def prune(directory, max_files, max_bytes): # deletes the oldest profiles until both limits hold
+    files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(directory) if entry.name.endswith('.pstats'))
+    total = sum(size for _, size, _ in files)
+    while files and (len(files) > max_files or total > max_bytes):
+        _, size, path = files.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def register(app):
+    if not app.config['PROFILE_ENABLED']:
+        return
+    directory = app.config['PROFILE_DIR']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    @app.before_request
+    def start_profile():
+        token = request.headers.get('X-Profile')
+        if random.random() < app.config['PROFILE_SAMPLE_RATE'] or (
+                token and valid_token(token, app.config['SECRET_KEY'])):
+            g.profile_start = perf_counter()
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.teardown_request
+    def save_profile(exc=None):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        duration = perf_counter() - g.profile_start
+        name = '{:.0f}-{}-{:.0f}ms.pstats'.format(
+            time() * 1000, re.sub(r'[^\w.]', '_', request.endpoint or 'none'), duration * 1000)
+        try:
+            profiler.dump_stats(os.path.join(directory, name))
+            prune(directory, app.config['PROFILE_MAX_FILES'], app.config['PROFILE_MAX_BYTES'])
+        except OSError as e:
+            app.logger.error('Could not save profile %s: %s', name, e)
@@ -0,0 +1,127 @@
+import random
+from functools import wraps
+from threading import Lock
+from time import time, monotonic
+from flask import g, request, session, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import UpdateBase
+
+# read replicas. GET requests to views marked @read_only run their queries on one of SQLALCHEMY_REPLICA_URIS,
+# picked once per request so its queries see one consistent snapshot. everything else stays on the primary:
+# flushes, DML statements, other routes, background threads and the cli. once a request writes, the rest of it
+# reads from the primary, and so does the same browser for REPLICA_MAX_LAG seconds after, so a redirect after
+# a post doesn't land on a replica that hasn't caught up yet. every replica is checked at most every
+# REPLICA_CHECK_INTERVAL seconds (and right after it fails) by whichever request notices first, the others
+# keep using the last result meanwhile. one that can't be reached within REPLICA_CONNECT_TIMEOUT or, on
+# postgres, lags more than REPLICA_MAX_LAG is skipped until it recovers. without replicas nothing changes.
+
+
+class Replica(object):
+    def __init__(self, uri, connect_timeout):
+        self.uri = uri
+        connect_args = {}
+        if make_url(uri).get_backend_name() in ('postgresql', 'mysql'):
+            connect_args['connect_timeout'] = connect_timeout
+        self.engine = create_engine(uri, connect_args=connect_args)
+        self.healthy = True
+        self.checked = 0 # when the last check started
+
+    def check(self, max_lag):
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    lag = connection.scalar('SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())')
+                    self.healthy = lag is None or lag <= max_lag # None: not a standby, nothing to lag behind
+                else:
+                    connection.scalar('SELECT 1')
+                    self.healthy = True
+        except Exception:
+            self.healthy = False
+        return self.healthy
+
+
+class Replicas(object):
+    def __init__(self, app):
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.replicas = [Replica(uri, app.config['REPLICA_CONNECT_TIMEOUT'])
+                         for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+        self._lock = Lock() # only held to claim a check, not while it runs
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error', self._failed(replica))
+
+    def _failed(self, replica):
+        def handle_error(context): # e.g. the replica went away mid-request, skip it until the next check passes
+            if context.is_disconnect or context.connection is None:
+                replica.healthy = False
+                replica.checked = monotonic()
+        return handle_error
+
+    def _claim_check(self, replica): # True for the one thread that gets to check the replica now
+        with self._lock:
+            if monotonic() - replica.checked < self.check_interval:
+                return False
+            replica.checked = monotonic()
+            return True
+
+    def choose(self): # a healthy replica, or None for the primary
+        healthy = []
+        for replica in self.replicas:
+            if monotonic() - replica.checked >= self.check_interval and self._claim_check(replica):
+                replica.check(self.max_lag)
+            if replica.healthy:
+                healthy.append(replica)
+        return random.choice(healthy) if healthy else None
+
+
+def use_replica():
+    if not has_request_context() or not g.get('read_only') or g.get('wrote'):
+        return False
+    return session.get('primary_until', 0) < time()
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replicas = getattr(self.app, 'replicas', None)
+        if replicas is not None and replicas.replicas:
+            if isinstance(clause, UpdateBase): # insert, update and delete run on the primary, and so does the rest
+                wrote()
+            elif not self._flushing and use_replica():
+                replica = g.get('replica')
+                if replica is None or not replica.healthy: # first query of the request, or the replica just failed
+                    replica = g.replica = replicas.choose()
+                if replica is not None:
+                    return replica.engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(f): # GET requests to this view may read from a replica
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_only = request.method in ('GET', 'HEAD')
+        return f(*args, **kwargs)
+    return decorated
+
+
+def wrote(): # a request that wrote reads its own writes from the primary
+    if has_request_context():
+        g.wrote = True
+        session['primary_until'] = time() + current_app.config['REPLICA_MAX_LAG']
+
+
+def pin_to_primary(session_, flush_context):
+    if current_app.replicas.replicas:
+        wrote()
+
+
+def register(app, db):
+    app.replicas = Replicas(app)
+    if not event.contains(db.session, 'after_flush', pin_to_primary):
+        event.listen(db.session, 'after_flush', pin_to_primary)
@@ -1,26 +1,193 @@
+import re
+import sqlite3
+import threading
+from time import monotonic
 from flask import current_app
+from app.cache import LRUCache
+from app.metrics import timed
 
 # this is designed so it can be used in other apps
+# the functions at the bottom are the interface the models use, they hand off to current_app.search_backend,
+# which is an ElasticsearchBackend or, with SEARCH_BACKEND=sqlite, a local SQLite FTS5 index (no server needed).
 
-def add_to_index(index, model): #takes the sqlAlchemy model as second arg
-    if not current_app.elasticsearch: #return nothing if Elasticsearch server is not configured
-        return
+class SearchIndexError(Exception): # raised for failures worth retrying (connection errors, 429s and 5xx items)
+    pass
+
+def document(model): # the fields listed in __searchable__, as sent to Elasticsearch
     payload = {}
     for field in model.__searchable__: #__searchable__ from db post model
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload) #use sqlAlchemy post id for id in elasticsearch
+    return payload
+
+
+class ElasticsearchBackend(object):
+    def __init__(self, app):
+        self.app = app # reads app.elasticsearch on every call, None means search is not configured
+
+    @property
+    def enabled(self):
+        return bool(self.app.elasticsearch)
+
+    def index(self, index, id, payload):
+        self.app.elasticsearch.index(index=index, doc_type=index, id=id, body=payload) #use sqlAlchemy post id for id in elasticsearch
+
+    def delete(self, index, id):
+        self.app.elasticsearch.delete(index=index, doc_type=index, id=id)
+
+    def bulk(self, index, documents, removals):
+        actions = []
+        for id, payload in documents.items():
+            actions.append({'index': {'_index': index, '_type': index, '_id': id}})
+            actions.append(payload)
+        for id in removals:
+            actions.append({'delete': {'_index': index, '_type': index, '_id': id}})
+        if not actions:
+            return
+        try:
+            response = self.app.elasticsearch.bulk(body=actions, refresh='wait_for') # searchable once this returns
+        except Exception as e:
+            raise SearchIndexError(str(e))
+        if response.get('errors'):
+            for item in response['items']:
+                status = list(item.values())[0].get('status', 200)
+                if status == 429 or status >= 500: # 404 on a delete just means it is already gone
+                    raise SearchIndexError('bulk item failed with status {}'.format(status))
+
+    def query(self, index, query, page, per_page):
+        search = self.app.elasticsearch.search( #multi_match can search across multiple fields. fields = * searches in all fields, obv
+            index=index, doc_type=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+            'from': (page - 1) * per_page, 'size': per_page}) #pagination math
+        ids = [int(hit['_id']) for hit in search ['hits']['hits']] #list comprehension .. mmmmm
+        return ids, search['hits']['total'] #return list of IDs
+
+
+class SQLiteSearchBackend(object):
+    # one FTS5 table per index with the document id as rowid, ranked with FTS5's built-in bm25. every thread
+    # gets its own connection to the file and WAL mode lets searches run while the search queue writes.
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._tables = set()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _table(self, connection, index, fields=None): # quoted table name, created on first write with the document's fields
+        name = '"fts_{}"'.format(index.replace('"', ''))
+        if index not in self._tables:
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?",
+                ('fts_' + index.replace('"', ''),)).fetchone()
+            if not exists:
+                if fields is None:
+                    return None
+                connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, tokenize="unicode61")'.format(
+                    name, ', '.join('"{}"'.format(f) for f in fields)))
+            self._tables.add(index)
+        return name
+
+    def index(self, index, id, payload):
+        self.bulk(index, {id: payload}, ())
+
+    def delete(self, index, id):
+        self.bulk(index, {}, (id,))
+
+    def bulk(self, index, documents, removals):
+        if not documents and not removals:
+            return
+        connection = self._connection()
+        fields = sorted(next(iter(documents.values()))) if documents else None
+        with connection: # one transaction for the whole batch
+            table = self._table(connection, index, fields)
+            if table is None:
+                return
+            ids = [(id,) for id in list(documents) + list(removals)]
+            connection.executemany('DELETE FROM {} WHERE rowid = ?'.format(table), ids)
+            if documents:
+                connection.executemany('INSERT INTO {} (rowid, {}) VALUES (?, {})'.format(
+                    table, ', '.join('"{}"'.format(f) for f in fields), ', '.join('?' * len(fields))),
+                    [[id] + [payload.get(f) for f in fields] for id, payload in documents.items()])
+
+    def query(self, index, query, page, per_page):
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return [], 0
+        match = ' OR '.join('"{}"'.format(term) for term in terms) # any term matches, like multi_match
+        connection = self._connection()
+        table = self._table(connection, index)
+        if table is None:
+            return [], 0
+        rows = connection.execute('SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY rank LIMIT ? OFFSET ?'.format(table),
+                                  (match, per_page, (page - 1) * per_page)).fetchall()
+        total = connection.execute('SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(table),
+                                   (match,)).fetchone()[0]
+        return [row[0] for row in rows], total
+
+
+class SearchCache(object):
+    # (index, query, per_page, window) -> (ids, total). each backend call fetches a window of SEARCH_CACHE_PAGES
+    # pages, so paging through results is served locally. every index has a generation counter that is bumped
+    # when its documents change, a cached window from an older generation is only served for
+    # SEARCH_CACHE_STALENESS seconds, after that the query goes to the backend again. the counters live in
+    # generations (anything with generation(index) and bump(index), the search queue file in the app), so
+    # every process sees the bumps of the others.
+    def __init__(self, maxsize, ttl, staleness, pages, generations):
+        self.staleness = staleness
+        self.pages = pages
+        self.generations = generations
+        self._cache = LRUCache(maxsize, ttl)
+
+    def generation(self, index):
+        return self.generations.generation(index)
+
+    def invalidate(self, index):
+        self.generations.bump(index)
+
+    def stats(self):
+        return self._cache.stats()
+
+    def query(self, index, query, page, per_page, fetch):
+        window = per_page * self.pages
+        start = (page - 1) * per_page
+        key = (index, ' '.join(query.lower().split()), per_page, start // window)
+        entry = self._cache.get(key)
+        if entry is None or (entry[2] != self.generation(index) and
+                             monotonic() - entry[3] > self.staleness):
+            generation = self.generation(index) # read before the fetch, so a change made meanwhile isn't hidden
+            ids, total = fetch(index, query, start // window + 1, window)
+            entry = (ids, total, generation, monotonic())
+            self._cache.set(key, entry)
+        offset = start % window
+        return entry[0][offset:offset + per_page], entry[1]
+
+
+def add_to_index(index, model): #takes the sqlAlchemy model as second arg
+    if not current_app.search_backend.enabled: #return nothing if no search backend is configured
+        return
+    current_app.search_backend.index(index, model.id, document(model))
 
 def remove_from_index(index, model): #takes the sqlAlchemy model as second arg
-    if not current_app.elasticsearch:
+    if not current_app.search_backend.enabled:
+        return
+    current_app.search_backend.delete(index, model.id)
+
+def bulk_index(index, documents, removals): # one _bulk request for many {id: payload} documents and removed ids
+    if not current_app.search_backend.enabled:
         return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    current_app.search_backend.bulk(index, documents, removals)
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend.enabled:
         return [], 0
-    search = current_app.elasticsearch.search( #multi_match can search across multiple fields. fields = * searches in all fields, obv
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-        'from': (page - 1) * per_page, 'size': per_page}) #pagination math
-    ids = [int(hit['_id']) for hit in search ['hits']['hits']] #list comprehension .. mmmmm
-    return ids, search['hits']['total'] #return list of IDs
\ No newline at end of file
+    with timed('search'):
+        return current_app.search_cache.query(index, query, page, per_page,
+                                              current_app.search_backend.query)
@@ -0,0 +1,177 @@
+import json
+import sqlite3
+try:
+    import fcntl
+except ImportError: # windows, run a single process per queue file there
+    fcntl = None
+from threading import Thread, Lock, Event
+from time import sleep, monotonic
+from app.search import bulk_index
+
+# durable queue between SearchableMixin.after_commit and the search backend. commits only append a row to
+# a local SQLite file, a background thread drains it in batches through bulk_index() (the _bulk API on
+# Elasticsearch), keeping only the last change per document id, and retries with exponential backoff while
+# the backend is slow or down. rows are deleted once the backend accepts them, so anything still queued
+# survives a restart.
+# the same file also keeps the high-water mark of SearchableMixin.reindex() so it can resume after a crash,
+# and the generation of every index that SearchCache compares its windows against, so a change any worker
+# makes expires the cached searches of all of them.
+# every web worker appends to the file but only one process drains it, the one holding the flock on
+# <path>.lock. two drainers could send overlapping batches, and a late one would put an older version of a
+# document back over a newer one. the others keep polling and take over when that process exits.
+
+
+class SearchQueue(object):
+    def __init__(self, app):
+        self.app = app
+        self.path = app.config['SEARCH_QUEUE_PATH']
+        self.batch_size = app.config['SEARCH_QUEUE_BATCH_SIZE']
+        self.max_backoff = app.config['SEARCH_QUEUE_MAX_BACKOFF']
+        self._db = None
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._idle = Event()
+        self._idle.set()
+        self._worker = None
+        self._lockfile = None
+
+    def _connection(self): # opened on first use, so apps without a search backend never create the file
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS queue ('
+                             'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'idx TEXT, doc_id INTEGER, op TEXT, body TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS reindex_checkpoint ('
+                             'idx TEXT PRIMARY KEY, last_id INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS generation ('
+                             'idx TEXT PRIMARY KEY, n INTEGER)')
+        return self._db
+
+    def generation(self, index): # bumped whenever the documents of the index change, in any process
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT n FROM generation WHERE idx = ?', (index,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, index):
+        with self._lock:
+            connection = self._connection()
+            connection.execute('INSERT OR IGNORE INTO generation (idx, n) VALUES (?, 0)', (index,))
+            connection.execute('UPDATE generation SET n = n + 1 WHERE idx = ?', (index,))
+
+    def checkpoint(self, index): # highest id a reindex of this index is known to have sent, 0 if none
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT last_id FROM reindex_checkpoint WHERE idx = ?',
+                (index,)).fetchone()
+        return row[0] if row else 0
+
+    def set_checkpoint(self, index, last_id):
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO reindex_checkpoint (idx, last_id) '
+                'VALUES (?, ?)', (index, last_id))
+
+    def add(self, index, id, payload):
+        self._put(index, id, 'index', json.dumps(payload, default=str))
+
+    def remove(self, index, id):
+        self._put(index, id, 'delete', None)
+
+    def _put(self, index, id, op, body):
+        with self._lock:
+            self._idle.clear()
+            self._connection().execute(
+                'INSERT INTO queue (idx, doc_id, op, body) VALUES (?, ?, ?, ?)',
+                (index, id, op, body))
+        self.start()
+        self._wakeup.set()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT count(*) FROM queue').fetchone()[0]
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = Thread(target=self._run, name='search-queue',
+                                  daemon=True)
+            self._worker.start()
+
+    def join(self, timeout=None): # blocks until everything queued so far has been sent, for tests and shutdown
+        deadline = monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - monotonic() if deadline is not None else None
+            if not self._idle.wait(remaining) and remaining is not None:
+                return False
+            if len(self) == 0:
+                return True
+            self._wakeup.set()
+            sleep(0.01)
+
+    def _drainer(self): # True once this process holds the drain lock on the queue file
+        if self._lockfile is not None:
+            return True
+        if self.path == ':memory:' or fcntl is None:
+            self._lockfile = True
+            return True
+        lockfile = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: # another process drains this file
+            lockfile.close()
+            return False
+        self._lockfile = lockfile # held until the process exits
+        return True
+
+    def _take(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT seq, idx, doc_id, op, body FROM queue ORDER BY seq '
+                'LIMIT ?', (self.batch_size,)).fetchall()
+
+    def _done(self, rows):
+        with self._lock:
+            self._connection().executemany(
+                'DELETE FROM queue WHERE seq = ?', [(row[0],) for row in rows])
+
+    def drain_once(self):
+        if not self._drainer():
+            return 0
+        rows = self._take()
+        if not rows:
+            return 0
+        batches = {} # index -> (documents, removals), a later change to the same id replaces an earlier one
+        for seq, index, id, op, body in rows:
+            documents, removals = batches.setdefault(index, ({}, set()))
+            if op == 'index':
+                documents[id] = json.loads(body)
+                removals.discard(id)
+            else:
+                documents.pop(id, None)
+                removals.add(id)
+        with self.app.app_context():
+            for index, (documents, removals) in batches.items():
+                bulk_index(index, documents, removals) # returns once the changes are searchable
+                self.app.search_cache.invalidate(index) # searches cached before the backend caught up are stale too
+        self._done(rows)
+        return len(rows)
+
+    def _run(self):
+        backoff = 0
+        while True:
+            try:
+                sent = self.drain_once()
+                backoff = 0
+            except Exception as e: # SearchIndexError or anything else, the rows stay queued either way
+                backoff = min(backoff * 2 or 0.5, self.max_backoff)
+                self.app.logger.warning('Search indexing failed, retrying in '
+                                        '%.1fs: %s', backoff, e)
+                sleep(backoff)
+                continue
+            if sent:
+                continue
+            self._idle.set()
+            self._wakeup.wait(1)
+            self._wakeup.clear()
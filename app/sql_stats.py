@@ -0,0 +1,80 @@
+import heapq
+from collections import Counter
+from time import perf_counter
+from flask import g, request, current_app, has_app_context, has_request_context
+from sqlalchemy.engine import Engine
+from app import db
+
+# per-request SQL numbers from the engine's cursor events: statement count, total time in the database and the
+# SQL_SLOWEST slowest statements, kept on g.sql for the rest of the request. statements slower than
+# SQL_SLOW_QUERY_MS are logged (background threads included), so are statements a request ran
+# SQL_N_PLUS_ONE_THRESHOLD times or more with the same sql, which is usually a lazy load inside a loop.
+# with SQL_SERVER_TIMING the numbers go back to the browser in a Server-Timing header.
+
+
+class RequestQueries(object):
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.time = 0.0 # seconds
+        self.slowest = [] # min-heap of (seconds, statement)
+        self.shapes = Counter() # statement -> times run
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.shapes[statement] += 1
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (elapsed, statement))
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (elapsed, statement))
+
+    def repeated(self, threshold):
+        return [(statement, count) for statement, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # the start goes on the statement's execution context, which is thrown away with it even if the statement
+    # raises and after_cursor_execute never runs
+    if context is not None:
+        context.query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'query_start', None)
+    if start is None:
+        return
+    elapsed = perf_counter() - start
+    if not has_app_context():
+        return
+    if has_request_context():
+        queries = g.get('sql')
+        if queries is not None:
+            queries.record(statement, elapsed)
+    if elapsed * 1000 >= current_app.config['SQL_SLOW_QUERY_MS']:
+        current_app.logger.warning('Slow query (%.1fms) in %s: %s', elapsed * 1000,
+                                   request.endpoint if has_request_context() else 'background',
+                                   statement)
+
+# every engine, so the replicas are covered too. outside a request only slow queries are logged
+db.event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+db.event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def register(app):
+    @app.before_request
+    def start_queries():
+        g.sql = RequestQueries(app.config['SQL_SLOWEST'])
+
+    @app.after_request
+    def report_queries(response):
+        queries = g.get('sql')
+        if queries is None:
+            return response
+        for statement, count in queries.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD']):
+            app.logger.warning('Possible N+1 in %s: %d x %s', request.endpoint, count, statement)
+        if app.config['SQL_SERVER_TIMING']:
+            response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(
+                queries.time * 1000, queries.count))
+        return response
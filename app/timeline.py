@@ -0,0 +1,191 @@
+from flask import current_app
+from app import db
+from app.pagination import parse_cursors, keyset_filter, keyset_order, keyset_page
+
+# materialized home timelines (fan-out-on-write). every post is copied as a (user_id, post_id, timestamp) row into
+# the timeline of its author and each follower when it is committed, so the home page reads a pre-sorted slice
+# off ix_timeline_user_id_timestamp_post_id instead of building the followers JOIN + UNION on every hit. authors
+# with more than TIMELINE_FANOUT_LIMIT followers (user.follower_count) are skipped at write time and merged
+# back in at read time (fan-out-on-read).
+
+def enabled():
+    return current_app.config.get('TIMELINE_ENABLED', False)
+
+
+def _fanout_limit():
+    return current_app.config['TIMELINE_FANOUT_LIMIT']
+
+
+def is_celebrity(connection, user_id):
+    from app.models import User
+    count = connection.execute(db.select([User.follower_count]).where(
+        User.id == user_id)).scalar()
+    return (count or 0) > _fanout_limit()
+
+
+def celebrity_ids(user):
+    # ids of the accounts this user follows that are too big to fan out, their posts are read on demand.
+    # one primary key lookup per followed account, no counting
+    from app.models import User, followers
+    rows = db.session.execute(db.select([User.id]).where(db.and_(
+        User.id.in_(db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id)),
+        User.follower_count > _fanout_limit())))
+    return [row[0] for row in rows]
+
+
+def fan_out(connection, post):
+    # one INSERT .. SELECT copies the post into every follower timeline, no python loop over followers
+    from app.models import followers, timeline
+    connection.execute(timeline.insert().values(
+        user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+    if is_celebrity(connection, post.user_id):
+        trim_some(connection, db.select([db.literal(post.user_id)]), post.id)
+        return
+    connection.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, db.literal(post.id),
+                   db.literal(post.timestamp)]).where(
+            followers.c.followed_id == post.user_id)))
+    trim_some(connection, db.select([followers.c.follower_id]).where(
+        followers.c.followed_id == post.user_id).union_all(
+            db.select([db.literal(post.user_id)])), post.id)
+
+
+def remove_post(connection, post):
+    from app.models import timeline
+    connection.execute(timeline.delete().where(timeline.c.post_id == post.id))
+
+
+def backfill(user, followed):
+    # copy the most recent posts of a newly followed account so the home page is complete right away
+    from app.models import Post, timeline
+    if followed.id != user.id and is_celebrity(db.session, followed.id):
+        return
+    recent = db.select([db.literal(user.id), Post.id, Post.timestamp]).where(
+        Post.user_id == followed.id).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_MAX_LENGTH'])
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'], recent))
+    trim(user.id)
+
+
+def demoted(author):
+    # the author just dropped to TIMELINE_FANOUT_LIMIT followers, so their posts are no longer read on demand.
+    # copy their recent posts into every follower timeline that doesn't have them yet
+    from app.models import Post, followers, timeline
+    db.session.flush()
+    recent = db.select([Post.id, Post.timestamp]).where(
+        Post.user_id == author.id).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_MAX_LENGTH']).alias('recent')
+    existing = timeline.alias('existing')
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, recent.c.id, recent.c.timestamp]).where(db.and_(
+            followers.c.followed_id == author.id,
+            ~db.exists().where(db.and_(existing.c.user_id == followers.c.follower_id,
+                                       existing.c.post_id == recent.c.id))))))
+
+
+def remove_author(user, followed):
+    from app.models import Post, timeline
+    db.session.execute(timeline.delete().where(db.and_(
+        timeline.c.user_id == user.id,
+        timeline.c.post_id.in_(db.select([Post.id]).where(
+            Post.user_id == followed.id)))))
+
+
+def trim_users(connection, user_ids):
+    # keep only the newest TIMELINE_MAX_LENGTH rows of every timeline in user_ids (a list or a select of ids).
+    # the cutoffs are read first and then deleted below: mysql won't run a DELETE whose subquery reads the
+    # table it deletes from (error 1093)
+    from app.models import timeline
+    newer = timeline.alias('newer')
+    cutoff = db.select([newer.c.timestamp]).where(
+        newer.c.user_id == timeline.c.user_id).order_by(
+            newer.c.timestamp.desc()).limit(1).offset(
+                current_app.config['TIMELINE_MAX_LENGTH']).as_scalar()
+    cutoffs = [{'trim_user_id': user_id, 'cutoff': timestamp} for user_id, timestamp in connection.execute(
+        db.select([timeline.c.user_id, cutoff]).where(timeline.c.user_id.in_(user_ids)).distinct())
+        if timestamp is not None]
+    if cutoffs:
+        connection.execute(timeline.delete().where(db.and_(
+            timeline.c.user_id == db.bindparam('trim_user_id'),
+            timeline.c.timestamp <= db.bindparam('cutoff'))), cutoffs)
+
+
+def trim_some(connection, user_ids, post_id):
+    # trimming every follower on every post would cost a cutoff lookup per follower per post, so each fan-out
+    # trims the timelines whose user id lines up with the post id: every timeline is trimmed on about one in
+    # TIMELINE_TRIM_EVERY of the posts it receives and stays around TIMELINE_MAX_LENGTH + TIMELINE_TRIM_EVERY rows
+    every = current_app.config['TIMELINE_TRIM_EVERY']
+    ids = user_ids.alias('ids')
+    id = list(ids.c)[0]
+    trim_users(connection, db.select([id]).where((id + post_id) % every == 0))
+
+
+def trim(user_id):
+    trim_users(db.session, [user_id])
+
+
+def rebuild(user):
+    from app.models import timeline
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id))
+    for followed in user.followed.all() + [user]:
+        backfill(user, followed)
+
+
+def home_timeline(user): # the whole timeline as a Post query, for the offset pages of old ?page= links
+    from app.models import Post, timeline, eager_load
+    materialized = Post.query.join(
+        timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == user.id)
+    celebrities = celebrity_ids(user)
+    if celebrities:
+        materialized = materialized.union(
+            Post.query.filter(Post.user_id.in_(celebrities)))
+    return materialized.options(eager_load(Post.author)).order_by(Post.timestamp.desc())
+
+
+def home_page(user, per_page, before=None, after=None):
+    # one keyset page of the home timeline. the (timestamp, post_id) keys of the next per_page + 1 rows come
+    # straight off the timeline index, the followed celebrities add theirs from ix_post_user_id_timestamp_id,
+    # and only the posts that make the page are loaded. cursors are the same (timestamp, id) tokens as paginate()
+    from app.models import Post, timeline, eager_load
+    cursor, newer = parse_cursors(before, after)
+    sources = [(db.select([timeline.c.timestamp, timeline.c.post_id]).where(
+        timeline.c.user_id == user.id), timeline.c.timestamp, timeline.c.post_id)]
+    for id in celebrity_ids(user):
+        sources.append((db.select([Post.timestamp, Post.id]).where(Post.user_id == id),
+                        Post.timestamp, Post.id))
+    keys = set()
+    for select, timestamp, id in sources:
+        if cursor is not None:
+            select = select.where(keyset_filter(timestamp, id, cursor, newer))
+        keys.update(tuple(row) for row in db.session.execute(
+            select.order_by(*keyset_order(timestamp, id, newer)).limit(per_page + 1)))
+    keys = sorted(keys, reverse=not newer)[:per_page + 1]
+    found = {post.id: post for post in Post.query.options(eager_load(Post.author)).filter(
+        Post.id.in_([id for timestamp, id in keys]))} if keys else {}
+    items = [found[id] for timestamp, id in keys if id in found]
+    return keyset_page(items, per_page, newer, cursor is not None)
+
+
+def before_flush(session, flush_context, instances):
+    # timeline rows reference the post, so they have to go before the post row is deleted
+    if not enabled():
+        return
+    from app.models import Post
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            remove_post(session.connection(), obj)
+
+
+def after_flush(session, flush_context):
+    # runs inside the flush, so the timeline rows commit (or roll back) together with the post
+    if not enabled():
+        return
+    from app.models import Post
+    for obj in session.new:
+        if isinstance(obj, Post):
+            fan_out(session.connection(), obj)
@@ -1,18 +1,201 @@
 import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from hashlib import sha1
+from threading import Lock
+from time import monotonic
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
 from flask_babel import _
+from app.cache import LRUCache
+from app.metrics import timed
+
+
+class TranslationCache(object):
+    # (sha1(text), source, dest) -> translation. an in-memory LRU sits in front of a SQLite file, so repeated
+    # clicks on the same post are answered from memory and translations survive restarts.
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.memory = LRUCache(maxsize)
+        self._db = None
+        self._lock = Lock()
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS translation ('
+                             'digest TEXT, source TEXT, dest TEXT, result TEXT, '
+                             'PRIMARY KEY (digest, source, dest))')
+        return self._db
+
+    @staticmethod
+    def key(text, source_language, dest_language):
+        return (sha1(text.encode('utf-8')).hexdigest(), source_language, dest_language)
+
+    def get(self, key):
+        result = self.memory.get(key)
+        if result is not None:
+            return result
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT result FROM translation WHERE digest = ? AND source = ? '
+                'AND dest = ?', key).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        self.memory.set(key, result)
+        return result
+
+    def set(self, key, result):
+        self.memory.set(key, result)
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO translation (digest, source, dest, result) '
+                'VALUES (?, ?, ?, ?)', key + (json.dumps(result),))
+
+
+class CircuitBreaker(object):
+    # stops calling the translator while it is failing. after failure_threshold failures in a row (errors, 5xx
+    # or answers slower than the latency budget) the breaker opens and calls fail fast for reset_timeout
+    # seconds. then it goes half-open and lets a single trial call through, which closes it again on success
+    # or reopens it on failure. stats() has the state, trip count and upstream latency percentiles.
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout, samples=1000):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=samples) # seconds, most recent upstream calls
+        self._opened_at = 0
+        self._trial = False
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._trial):
+                self._trial = self.state == self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            if ok:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self._opened_at = monotonic()
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+    def stats(self):
+        return {'state': self.state, 'trips': self.trips, 'rejected': self.rejected,
+                'failures': self.failures, 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+def translator_session(pool_size): # one keep-alive session per app, shared by every request thread
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 def translate(text, source_language, dest_language):
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']: #checks if the key is configured. I need to re-enter the key every time. don't know why
         return _('ERROR: the translation service is not configured.')
+    cache = current_app.translation_cache
+    cache_key = cache.key(text, source_language, dest_language)
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
     #auth = {'yandex-key': app.config['MS_TRANSLATOR_KEY']}
     key = current_app.config['MS_TRANSLATOR_KEY'] #takes key from os
-    lang = source_language + "-" + dest_language 
-    str = 'https://translate.yandex.net/api/v1.5/tr.json/translate?key={}&text={}&lang={}' .format(key, text, lang)
-    r = requests.get(str)
-    if r.status_code != 200: #error message if it isn't a successful 200 code
+    lang = source_language + "-" + dest_language
+    with timed('translator'):
+        result = upstream({'key': key, 'text': text, 'lang': lang}) # requests encodes the text, it used to go into the url as is
+    if result is None: #error message if it isn't a successful 200 code
         return _('Error: the translation service failed.')
-    result = json.loads(r.content.decode('utf-8-sig')) 
-    return result['text'] #return result with 'text' key specified
\ No newline at end of file
+    cache.set(cache_key, result) # only successful translations are cached
+    return result
+
+
+def upstream(params):
+    # one call to the translator through the circuit breaker, returns the 'text' list or None. TRANSLATOR_TIMEOUT
+    # is the latency budget, a slower answer is returned but still counts as a failure for the breaker.
+    breaker = current_app.translator_breaker
+    if not breaker.allow(): # open, fail fast without touching the network
+        return None
+    budget = current_app.config['TRANSLATOR_TIMEOUT']
+    trips = breaker.trips
+    start = monotonic()
+    try:
+        r = current_app.translator_session.get(
+            current_app.config['TRANSLATOR_URL'], params=params, timeout=budget)
+    except requests.RequestException:
+        r = None
+    latency = monotonic() - start
+    breaker.record(r is not None and r.status_code < 500 and latency <= budget, latency)
+    if breaker.trips != trips:
+        current_app.logger.warning('Translator circuit breaker opened: %s', breaker.stats())
+    if r is None or r.status_code != 200:
+        return None
+    return json.loads(r.content.decode('utf-8-sig'))['text'] #result with 'text' key specified
+
+
+def translate_batch(texts, source_language, dest_language):
+    # like translate() for a list of texts in one language pair. cached texts are answered locally, the rest
+    # go upstream in a single request with one text= parameter each. returns one string per text, None where
+    # the translation failed. this runs in worker threads without a request context, so no _() in here.
+    cache = current_app.translation_cache
+    keys = [cache.key(text, source_language, dest_language) for text in texts]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        translated = upstream([('key', current_app.config['MS_TRANSLATOR_KEY']),
+                               ('lang', source_language + '-' + dest_language)] +
+                              [('text', texts[i]) for i in missing])
+        for n, i in enumerate(missing):
+            if translated is not None and n < len(translated):
+                results[i] = [translated[n]] # same shape translate() returns and caches
+                cache.set(keys[i], results[i])
+    return [' '.join(result) if result is not None else None for result in results]
+
+
+def translate_groups(groups):
+    # {(source, dest): [texts]} -> {(source, dest): [translations]}, with up to TRANSLATOR_BATCH_CONCURRENCY
+    # language pairs sent upstream at the same time
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
+        error = _('ERROR: the translation service is not configured.')
+        return {pair: [error] * len(texts) for pair, texts in groups.items()}
+    app = current_app._get_current_object()
+
+    def run(pair):
+        with app.app_context():
+            return translate_batch(groups[pair], *pair)
+
+    pairs = list(groups)
+    with timed('translator'), ThreadPoolExecutor(max_workers=app.config['TRANSLATOR_BATCH_CONCURRENCY']) as pool:
+        results = dict(zip(pairs, pool.map(run, pairs)))
+    return {pair: [text if text is not None else _('Error: the translation service failed.')
+                   for text in texts] for pair, texts in results.items()}
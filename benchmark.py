@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# benchmarks for the main routes. builds a seeded data set through the real models at each size, times the
+# routes through the test client and writes the results as json. `compare` fails when a run is slower or
+# issues more queries than a baseline run.
+#
+#   python benchmark.py run --sizes 100x1000,1000x10000 --output new.json
+#   python benchmark.py compare baseline.json new.json --threshold 0.2
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+import click
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+WORDS = ['cat', 'dog', 'flask', 'python', 'coffee', 'music', 'rain', 'travel',
+         'book', 'code', 'lunch', 'train', 'garden', 'movie', 'weekend', 'sun']
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    SEARCH_BACKEND = 'sqlite' # search works without an elasticsearch server
+    SEARCH_QUEUE_PATH = ':memory:'
+    TRANSLATION_CACHE_PATH = ':memory:'
+    LANGUAGE_WORKERS = 0
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    MAIL_SERVER = None
+
+
+def zipf_weights(n, exponent):
+    return [1.0 / (rank + 1) ** exponent for rank in range(n)]
+
+
+def generate(users, posts, seed=0, exponent=1.2):
+    # users user0..userN with password 'cat' and a power-law follow graph: how many users someone follows and
+    # how likely they are to be followed both fall off with rank, so a few users have most of the followers.
+    # posts are spread over the 30 days before 2020-01-01 with authors drawn from the same skewed distribution.
+    rng = random.Random(seed)
+    base = datetime(2020, 1, 1)
+    everyone = [User(username='user{}'.format(i), email='user{}@example.com'.format(i),
+                     last_seen=base) for i in range(users)]
+    everyone[0].set_password('cat')
+    for user in everyone[1:]: # hashing once is enough, only user0 logs in
+        user.password_hash = everyone[0].password_hash
+    db.session.add_all(everyone)
+    db.session.commit()
+
+    weights = zipf_weights(users, exponent)
+    for i, user in enumerate(everyone):
+        count = min(users - 1, int(rng.paretovariate(1.5) * 3))
+        for followed in set(rng.choices(everyone, weights, k=count)):
+            if followed is not user:
+                user.follow(followed)
+        if i % 100 == 99:
+            db.session.commit()
+    db.session.commit()
+
+    authors = rng.choices(everyone, weights, k=posts)
+    for i, author in enumerate(authors):
+        db.session.add(Post(body=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+                            author=author, language='en',
+                            timestamp=base - timedelta(seconds=rng.randint(0, 30 * 86400))))
+        if i % 1000 == 999:
+            db.session.commit()
+    db.session.commit()
+    return everyone
+
+
+class QueryCounter(object): # counts the statements sent to the database inside a with block, tests.py uses it too
+    def __enter__(self):
+        self.count = 0
+        db.event.listen(db.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+def scenarios(rng, users):
+    # name -> function(client) making one request. follow alternates between following and unfollowing the
+    # same users, so repeated runs don't change the size of the graph.
+    state = {'following': False, 'post': 0}
+
+    def follow(client):
+        target = 'user{}'.format(users - 1)
+        client.get('/{}/{}'.format('unfollow' if state['following'] else 'follow', target))
+        state['following'] = not state['following']
+
+    def create_post(client):
+        state['post'] += 1
+        client.post('/index', data={'post': 'benchmark post {}'.format(state['post'])})
+
+    return [
+        ('index', lambda client: client.get('/index')),
+        ('explore', lambda client: client.get('/explore')),
+        ('user', lambda client: client.get('/user/user{}'.format(rng.randrange(users)))),
+        ('search', lambda client: client.get('/search?q={}'.format(rng.choice(WORDS)))),
+        ('follow', follow),
+        ('post', create_post),
+    ]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def run_size(users, posts, seed, repeat, warmup):
+    tmp = tempfile.TemporaryDirectory()
+
+    class SizeConfig(BenchmarkConfig):
+        SEARCH_INDEX_PATH = os.path.join(tmp.name, 'index.db')
+
+    app = create_app(SizeConfig)
+    app.logger.disabled = True
+    app_context = app.app_context()
+    app_context.push()
+    try:
+        db.create_all()
+        generate(users, posts, seed)
+        app.search_queue.join(timeout=60)
+        db.session.remove()
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+        rng = random.Random(seed)
+        results = {}
+        for name, request in scenarios(rng, users):
+            for i in range(warmup):
+                request(client)
+            latencies = []
+            queries = []
+            for i in range(repeat):
+                with QueryCounter() as counter:
+                    start = perf_counter()
+                    request(client)
+                    latencies.append((perf_counter() - start) * 1000)
+                queries.append(counter.count)
+            results[name] = {'median_ms': round(percentile(latencies, 50), 3),
+                             'p95_ms': round(percentile(latencies, 95), 3),
+                             'queries': max(queries)}
+        return results
+    finally:
+        app.last_seen.flush() # before the tables go, not at exit
+        db.session.remove()
+        db.drop_all()
+        app_context.pop()
+        tmp.cleanup()
+
+
+def parse_sizes(sizes):
+    return [tuple(int(n) for n in size.split('x')) for size in sizes.split(',')]
+
+
+def compare(baseline, current, threshold):
+    # list of regressions: a median slower by more than threshold (0.2 = 20%) or more queries than the baseline
+    regressions = []
+    for size, routes in current['results'].items():
+        for name, result in routes.items():
+            before = baseline['results'].get(size, {}).get(name)
+            if before is None:
+                continue
+            if result['median_ms'] > before['median_ms'] * (1 + threshold):
+                regressions.append('{} {}: median {:.2f}ms, was {:.2f}ms'.format(
+                    size, name, result['median_ms'], before['median_ms']))
+            if result['queries'] > before['queries']:
+                regressions.append('{} {}: {} queries, was {}'.format(
+                    size, name, result['queries'], before['queries']))
+    return regressions
+
+
+@click.group()
+def cli():
+    """Route benchmarks."""
+    pass
+
+
+@cli.command()
+@click.option('--sizes', default='50x500,200x2000', help='Comma separated USERSxPOSTS data sizes.')
+@click.option('--seed', default=0, help='Seed for the data generator.')
+@click.option('--repeat', default=20, help='Timed requests per route and size.')
+@click.option('--warmup', default=3, help='Untimed requests per route first.')
+@click.option('--output', type=click.File('w'), default='-', help='Where the json goes.')
+def run(sizes, seed, repeat, warmup, output):
+    """Time the main routes at each data size."""
+    results = {}
+    for users, posts in parse_sizes(sizes):
+        click.echo('{} users, {} posts...'.format(users, posts), err=True)
+        results['{}x{}'.format(users, posts)] = run_size(users, posts, seed, repeat, warmup)
+    json.dump({'seed': seed, 'repeat': repeat, 'python': platform.python_version(),
+               'results': results}, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+@cli.command(name='compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=0.2, help='Allowed slowdown of the median, 0.2 is 20%.')
+def compare_command(baseline, current, threshold):
+    """Fail when CURRENT regressed against BASELINE."""
+    regressions = compare(json.load(baseline), json.load(current), threshold)
+    for regression in regressions:
+        click.echo(regression)
+    if regressions:
+        sys.exit(1)
+    click.echo('No regressions.')
+
+
+if __name__ == '__main__':
+    cli()
@@ -10,13 +10,75 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG') or 5) # seconds, also how long a browser reads from the primary after a write
+    REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL') or 10)
+    REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT') or 2) # seconds, postgres and mysql
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+    MAIL_ENQUEUE_TIMEOUT = float(os.environ.get('MAIL_ENQUEUE_TIMEOUT') or 5)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
     ADMINS = ['your-email@example.com']
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_URL = os.environ.get('TRANSLATOR_URL') or \
+        'https://translate.yandex.net/api/v1.5/tr.json/translate'
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 3)
+    TRANSLATOR_POOL_SIZE = int(os.environ.get('TRANSLATOR_POOL_SIZE') or 10)
+    TRANSLATOR_BATCH_CONCURRENCY = int(os.environ.get('TRANSLATOR_BATCH_CONCURRENCY') or 4)
+    TRANSLATOR_FAILURE_THRESHOLD = int(os.environ.get('TRANSLATOR_FAILURE_THRESHOLD') or 5)
+    TRANSLATOR_RESET_TIMEOUT = float(os.environ.get('TRANSLATOR_RESET_TIMEOUT') or 30)
+    TRANSLATION_CACHE_PATH = os.environ.get('TRANSLATION_CACHE_PATH') or \
+        os.path.join(basedir, 'translations.db')
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
     POSTS_PER_PAGE = 25
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'elasticsearch' # or 'sqlite'
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or \
+        os.path.join(basedir, 'search-index.db')
+    TIMELINE_ENABLED = os.environ.get('TIMELINE_ENABLED') is not None
+    TIMELINE_MAX_LENGTH = int(os.environ.get('TIMELINE_MAX_LENGTH') or 800)
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    TIMELINE_TRIM_EVERY = int(os.environ.get('TIMELINE_TRIM_EVERY') or 50) # each timeline is trimmed on about one in this many posts
+    FOLLOW_GRAPH_CACHE_SIZE = int(os.environ.get('FOLLOW_GRAPH_CACHE_SIZE') or 10000)
+    FOLLOW_GRAPH_CACHE_TTL = int(os.environ.get('FOLLOW_GRAPH_CACHE_TTL') or 300)
+    FOLLOW_GRAPH_CACHE_IDS = int(os.environ.get('FOLLOW_GRAPH_CACHE_IDS') or 1000000) # followed ids over all entries, roughly 100 bytes each
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+    LAST_SEEN_FLUSH_USERS = int(os.environ.get('LAST_SEEN_FLUSH_USERS') or 100)
+    SEARCH_QUEUE_PATH = os.environ.get('SEARCH_QUEUE_PATH') or \
+        os.path.join(basedir, 'search-queue.db')
+    SEARCH_QUEUE_BATCH_SIZE = int(os.environ.get('SEARCH_QUEUE_BATCH_SIZE') or 500)
+    SEARCH_QUEUE_MAX_BACKOFF = int(os.environ.get('SEARCH_QUEUE_MAX_BACKOFF') or 60)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    SEARCH_CACHE_STALENESS = int(os.environ.get('SEARCH_CACHE_STALENESS') or 5)
+    SEARCH_CACHE_PAGES = int(os.environ.get('SEARCH_CACHE_PAGES') or 5)
+    POST_AUTHOR_LOADING = os.environ.get('POST_AUTHOR_LOADING') or 'joined' # or 'selectin', how post lists load the authors
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES') or 16 * 1024 * 1024)
+    LANGUAGE_WORKERS = int(os.environ.get('LANGUAGE_WORKERS') or 2) # 0 detects inline
+    LANGUAGE_BATCH_SIZE = int(os.environ.get('LANGUAGE_BATCH_SIZE') or 100)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2) # 0 hashes inline
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 16) # queued + running
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS') or 100)
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 10)
+    SQL_SLOWEST = int(os.environ.get('SQL_SLOWEST') or 5)
+    SQL_SERVER_TIMING = os.environ.get('SQL_SERVER_TIMING') is not None
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # lets a prometheus scraper read /metrics without logging in
+    PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED') is not None
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0.001) # plus requests with an X-Profile token
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'logs', 'profiles')
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES') or 200)
+    PROFILE_MAX_BYTES = int(os.environ.get('PROFILE_MAX_BYTES') or 100 * 1024 * 1024)
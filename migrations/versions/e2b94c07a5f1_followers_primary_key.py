@@ -0,0 +1,48 @@
+"""followers primary key
+
+Revision ID: e2b94c07a5f1
+Revises: 3a8d2f61c4e7
+Create Date: 2026-10-18 11:26:50.917364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b94c07a5f1'
+down_revision = '3a8d2f61c4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # copy the distinct edges into a table with the composite primary key, then swap it in.
+    # SQLite can't add a primary key to an existing table, so this works the same on every backend.
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
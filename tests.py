@@ -1,14 +1,53 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from flask import g
+import requests
 from app import create_app, db
-from app.models import User, Post
+from app.email import send_email
+from app import language
+from app.models import User, Post, followers, timeline
+from app.pagination import paginate
+from app.passwords import PasswordHasherBusy
+from app.profiler import profile_token
+from app.search import SearchIndexError
+from app.translate import translate, translate_groups, TranslationCache
+import benchmark
+from benchmark import QueryCounter
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_QUEUE_PATH = ':memory:'
+    TRANSLATION_CACHE_PATH = ':memory:'
+    LANGUAGE_WORKERS = 0
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+
+class FakeElasticsearch(object):
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.requests = []
+
+    def bulk(self, body, refresh=None):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('elasticsearch is down')
+        self.requests.append(body)
+        self.refresh = refresh
+        return {'errors': False, 'items': []}
 
 
 class UserModelCase(unittest.TestCase):
@@ -19,6 +58,7 @@ class UserModelCase(unittest.TestCase):
         db.create_all()
 
     def tearDown(self):
+        self.app.last_seen.stop()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -29,11 +69,64 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_hash_pool_and_upgrade(self):
+        self.app.password_hasher.workers = 1
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.password_needs_rehash())
+
+        self.app.password_hasher.method = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hasher_busy(self):
+        hasher = self.app.password_hasher
+        hasher.workers = 1
+        hasher.timeout = 0.2
+        with self.assertRaises(PasswordHasherBusy): # outlives the timeout, keeps its slot until it finishes
+            hasher._run(time.sleep, 0.5)
+        hasher._pending = threading.BoundedSemaphore(1)
+        hasher._pending.acquire()
+        with self.assertRaises(PasswordHasherBusy): # no free slot
+            hasher.hash('cat')
+        hasher._pending.release()
+        self.assertTrue(hasher.check(hasher.hash('cat'), 'cat'))
+
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        hasher._pending.acquire()
+        response = self.app.test_client().post('/auth/login', data={'username': 'susan',
+                                                                    'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/auth/login'))
+
+    def test_login_upgrades_hash(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.password_hasher.method = 'pbkdf2:sha256:2000'
+        self.app.test_client().post('/auth/login', data={'username': 'susan',
+                                                         'password': 'cat'})
+        db.session.expire_all()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'John@Example.com'
+        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
+                                         'd4c74594d841139328695756648b6bd6'
+                                         '?d=identicon&s=128'))
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -58,6 +151,42 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_graph_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        cache = self.app.follow_graph
+        self.assertFalse(u1.is_following(u2))
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(u1.is_following(u2))
+        self.assertEqual(u1.followed_ids(), frozenset([u2.id]))
+
+        u1.unfollow(u2)
+        db.session.rollback()
+        self.assertTrue(u1.is_following(u2))
+
+        # a set gone stale because another worker changed the edge doesn't decide writes
+        cache.set(u1.id, frozenset())
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u2.follower_count, 1)
+        db.session.execute(followers.delete())
+        db.session.commit()
+        cache.set(u1.id, frozenset([u2.id]))
+        u1.unfollow(u2)
+        db.session.commit()
+
+        # the cache is bounded by the number of ids it holds, not only by the number of users
+        cache.maxweight = 3
+        cache.set(1, frozenset([1, 2]))
+        cache.set(2, frozenset([3, 4]))
+        self.assertEqual((cache.get(1), cache.get(2), cache.weight), (None, frozenset([3, 4]), 2))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -96,6 +225,828 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_home_timeline(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # susan gets two followers, so her posts are read on demand
+        now = datetime.utcnow()
+        p1 = Post(body="old post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        db.session.commit()
+
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        p3 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        p4 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=4))
+        db.session.add_all([p2, p3, p4])
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p4, p3, p2, p1])
+        self.assertEqual(u1.home_timeline().all(),
+                         u1.followed_posts().all())
+
+        self.assertEqual(u2.follower_count, 2)
+        page = u1.home_page(2)
+        self.assertEqual(page.items, [p4, p3])
+        self.assertEqual(u1.home_page(2, before=page.next_cursor).items, [p2, p1])
+        self.assertEqual(u1.home_page(2, after=u1.home_page(
+            2, before=page.next_cursor).prev_cursor).items, [p4, p3])
+
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p4, p3, p1])
+
+        # mary unfollowing makes susan small enough to fan out again, her posts are copied over
+        u3.unfollow(u2)
+        db.session.commit()
+        rows = db.session.execute(db.select([timeline.c.post_id]).where(
+            timeline.c.user_id == u1.id)).fetchall()
+        self.assertEqual(sorted(row[0] for row in rows), [p1.id, p3.id, p4.id])
+        self.assertEqual(u1.home_page(10).items, [p4, p3, p1])
+
+        # and timelines are trimmed as posts come in
+        self.app.config['TIMELINE_MAX_LENGTH'] = 2
+        self.app.config['TIMELINE_TRIM_EVERY'] = 1
+        p5 = Post(body="another post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=5))
+        db.session.add(p5)
+        db.session.commit()
+        self.assertEqual(u1.home_page(10).items, [p5, p4])
+
+    def test_last_seen_buffer(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com',
+                  last_seen=datetime.utcnow())
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.last_seen = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        buffer = self.app.last_seen
+        buffer.interval = 3600
+
+        # susan was seen within the granularity, so only john is written
+        buffer.touch(u1)
+        buffer.touch(u2)
+        buffer.touch(u1)
+        self.assertEqual(buffer.flush(), 1)
+        db.session.expire_all()
+        self.assertLess(datetime.utcnow() - u1.last_seen, timedelta(minutes=1))
+        self.assertEqual(buffer.flush(), 0)
+
+        # the timer thread flushes without waiting for another request
+        u1.last_seen = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        buffer.touch(u1) # not due yet
+        self.assertEqual(len(buffer._pending), 1)
+        buffer.interval = 0.05
+        buffer._start_timer()
+        time.sleep(0.3)
+        self.assertEqual(buffer.flush(), 0)
+        db.session.expire_all()
+        self.assertLess(datetime.utcnow() - u1.last_seen, timedelta(minutes=1))
+        buffer.stop()
+        self.assertFalse(buffer._timer.is_alive())
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='This is a post written in the English language', author=u)
+        p2 = Post(body='Esta es una publicación escrita en español', author=u)
+        p3 = Post(body='?!', author=u, language=None)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        detector = language.LanguageDetector(self.app)
+        detector.workers = 1
+        detector.submit(p1)
+        detector.join()
+        detector.shutdown()
+        db.session.expire_all()
+        self.assertEqual(p1.language, 'en')
+
+        # the backfill picks up the posts still without a language
+        self.assertEqual(language.backfill(chunk_size=1, workers=1), 2)
+        db.session.expire_all()
+        self.assertEqual([p.language for p in (p1, p2, p3)], ['en', 'es', ''])
+        self.assertEqual(language.backfill(workers=1), 0)
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=[u1, u2][i % 2],
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = u1.followed_posts().order_by(None).order_by(
+            Post.timestamp.desc(), Post.id.desc()).all()
+
+        # walk older pages with ?before=, then back with ?after=
+        pages = [paginate(u1.followed_posts(), Post, 2)]
+        while pages[-1].has_next:
+            pages.append(paginate(u1.followed_posts(), Post, 2,
+                                  before=pages[-1].next_cursor))
+        self.assertEqual([p.items for p in pages],
+                         [expected[0:2], expected[2:4], expected[4:]])
+        newer = paginate(u1.followed_posts(), Post, 2,
+                         after=pages[-1].prev_cursor)
+        self.assertEqual(newer.items, expected[2:4])
+        self.assertTrue(newer.has_prev)
+        self.assertEqual(paginate(Post.query, Post, 2,
+                                  before='not a cursor').items, expected[0:2])
+
+
+class FakeTranslatorSession(object):
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, params, timeout):
+        params = list(params.items()) if isinstance(params, dict) else params
+        self.calls.append(params)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({'code': 200, 'text': [
+            value.upper() for name, value in params if name == 'text']}).encode('utf-8')
+        return response
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.translation_cache = TranslationCache(
+            os.path.join(self.tmp.name, 'translations.db'), 100)
+        self.app.translator_session = FakeTranslatorSession()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_translation_cache(self):
+        self.assertEqual(translate('hola & adios', 'es', 'en'), ['HOLA & ADIOS'])
+        self.assertEqual(translate('hola & adios', 'es', 'en'), ['HOLA & ADIOS'])
+        self.assertEqual(len(self.app.translator_session.calls), 1)
+        self.assertIn(('text', 'hola & adios'),
+                      self.app.translator_session.calls[0])
+
+        # a fresh cache on the same file (a restart) still has the translation
+        self.app.translation_cache = TranslationCache(
+            self.app.translation_cache.path, 100)
+        self.assertEqual(translate('hola & adios', 'es', 'en'), ['HOLA & ADIOS'])
+        self.assertEqual(len(self.app.translator_session.calls), 1)
+        translate('hola & adios', 'es', 'fr')
+        self.assertEqual(len(self.app.translator_session.calls), 2)
+
+
+    def test_translate_groups(self):
+        translate('uno', 'es', 'en')
+        results = translate_groups({('es', 'en'): ['uno', 'dos', 'tres'],
+                                    ('fr', 'en'): ['un']})
+        self.assertEqual(results, {('es', 'en'): ['UNO', 'DOS', 'TRES'],
+                                   ('fr', 'en'): ['UN']})
+        # 'uno' was cached, the rest is one upstream call per language pair
+        calls = self.app.translator_session.calls
+        self.assertEqual(len(calls), 3)
+        self.assertIn([('text', 'dos'), ('text', 'tres')],
+                      [[p for p in call if p[0] == 'text'] for call in calls])
+
+
+class FakeTranslatorHandler(BaseHTTPRequestHandler): # upper-cases the texts, server.delay and server.status shape the answer
+    def do_GET(self):
+        self.server.hits += 1
+        time.sleep(self.server.delay)
+        texts = parse_qs(urlparse(self.path).query).get('text', [])
+        body = json.dumps({'text': [text.upper() for text in texts]}).encode('utf-8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CircuitBreakerCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeTranslatorHandler)
+        self.server.hits, self.server.delay, self.server.status = 0, 0, 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app = create_app(TestConfig)
+        self.app.config.update(
+            MS_TRANSLATOR_KEY='key', TRANSLATOR_TIMEOUT=0.2,
+            TRANSLATOR_URL='http://127.0.0.1:{}/translate'.format(self.server.server_port))
+        self.app.translator_breaker.failure_threshold = 2
+        self.app.translator_breaker.reset_timeout = 0.2
+        self.app_context = self.app.test_request_context() # the error messages are translated for the request's locale
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = self.app.translator_breaker
+        self.assertEqual(translate('uno', 'es', 'en'), ['UNO'])
+
+        # a 500 and an answer slower than the budget trip the breaker, after that calls fail fast
+        self.server.status = 500
+        self.assertIn('failed', translate('dos', 'es', 'en'))
+        self.server.status, self.server.delay = 200, 0.3
+        self.assertIn('failed', translate('tres', 'es', 'en'))
+        self.assertEqual((breaker.state, breaker.trips), ('open', 1))
+        hits = self.server.hits
+        start = time.monotonic()
+        self.assertIn('failed', translate('cuatro', 'es', 'en'))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(self.server.hits, hits)
+
+        # after reset_timeout a half-open trial call closes it again
+        self.server.delay = 0
+        time.sleep(0.25)
+        self.assertEqual(translate('cinco', 'es', 'en'), ['CINCO'])
+        self.assertEqual(breaker.state, 'closed')
+        self.assertIsNotNone(breaker.stats()['p95'])
+
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError: # the mail tests need a local SMTP server
+    Controller = None
+
+
+class RecordingSMTPHandler(object):
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class MailPoolCase(unittest.TestCase):
+    def setUp(self):
+        import socket
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.handler = RecordingSMTPHandler()
+        self.smtp = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.smtp.start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 1
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app.mail_pool.shutdown()
+        self.app_context.pop()
+        self.smtp.stop()
+
+    def test_messages_share_a_connection(self):
+        for i in range(10):
+            self.assertTrue(send_email('message {}'.format(i), 'a@example.com',
+                                       ['b@example.com'], 'body', '<p>body</p>'))
+        self.app.mail_pool.join()
+        self.assertEqual(len(self.handler.messages), 10)
+        self.assertEqual(len(self.handler.sessions), 1)
+        self.assertEqual((self.app.mail_pool.sent, self.app.mail_pool.failed), (10, 0))
+
+    def test_full_queue_applies_backpressure(self):
+        pool = self.app.mail_pool
+        pool.start = lambda: None # no workers, so nothing drains the queue
+        pool.queue.maxsize = 2
+        pool.enqueue_timeout = 0.01
+        results = [send_email('message', 'a@example.com', ['b@example.com'],
+                              'body', '<p>body</p>') for i in range(3)]
+        self.assertEqual(results, [True, True, False])
+
+
+class RouteCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i)) for i in range(30)]
+        users[0].set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all(users + [
+            Post(body='post {}'.format(i), author=users[i % 30],
+                 timestamp=now - timedelta(seconds=i)) for i in range(60)])
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertConstantQueries(self, url, page_sizes=(5, 20, 50)):
+        # the number of statements a listing issues must not grow with the number of posts it shows
+        self.client.get(url) # warm up the in-process caches first
+        counts = []
+        for per_page in page_sizes:
+            self.app.config['POSTS_PER_PAGE'] = per_page
+            with QueryCounter() as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts.append(queries.count)
+        self.assertEqual(len(set(counts)), 1,
+                         '{} issued {} queries for page sizes {}'.format(
+                             url, counts, page_sizes))
+
+    def test_listing_query_counts(self):
+        for loading in ['joined', 'selectin']:
+            self.app.config['POST_AUTHOR_LOADING'] = loading
+            for url in ['/index', '/index?page=2', '/explore', '/user/user1', '/explore?page=2',
+                        '/search?q=post']:
+                self.assertConstantQueries(url)
+
+
+    def test_user_cache(self):
+        cache = self.app.user_cache
+        self.client.get('/edit_profile')
+        hits = cache.hits
+        with QueryCounter() as queries:
+            response = self.client.get('/edit_profile')
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(queries.count, 0)
+        self.assertIn(b'user0', response.data)
+
+        # a saved profile isn't served from the old cached copy
+        self.client.post('/edit_profile', data={'username': 'susan',
+                                                'about_me': 'hi'})
+        self.assertIn(b'susan', self.client.get('/edit_profile').data)
+
+    def test_sql_stats(self):
+        self.app.config['SQL_SERVER_TIMING'] = True
+        self.app.config['SQL_N_PLUS_ONE_THRESHOLD'] = 3
+        self.app.config['SQL_SLOW_QUERY_MS'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            with self.app.test_request_context('/'):
+                self.app.preprocess_request()
+                for user in User.query.limit(5): # one query per user, on purpose
+                    user.posts.count()
+                queries = g.sql
+                response = self.app.process_response(self.app.response_class())
+        self.assertEqual(queries.count, 6)
+        self.assertEqual(len(queries.slowest), self.app.config['SQL_SLOWEST'])
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertIn('6 queries', response.headers['Server-Timing'])
+        self.assertTrue(any('Slow query' in line for line in logs.output))
+        self.assertTrue(any('Possible N+1' in line and '5 x' in line
+                            for line in logs.output))
+
+        # a statement that fails leaves nothing behind on the pooled connection
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute('SELECT * FROM no_such_table')
+            self.assertNotIn('query_start', connection.info)
+            connection.execute('SELECT 1')
+
+    def test_metrics(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.client.get('/explore')
+        self.app.config['ADMINS'] = ['user0@example.com']
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('microblog_request_duration_seconds_count{endpoint="main.explore"} 1', text)
+        self.assertIn('microblog_db_duration_seconds_count{endpoint="main.explore"} 1', text)
+        self.assertIn('microblog_responses_total{endpoint="main.metrics",status="404"} 1', text)
+        self.assertIn('microblog_translator_breaker_open 0', text)
+
+        self.app.config['ADMINS'] = []
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        client = self.app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={
+            'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_metrics_threads(self):
+        metrics = self.app.metrics
+        threads = [threading.Thread(target=metrics.count_response, args=('main.explore', 200))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(2): # exited threads are folded in once, not per scrape
+            responses = metrics.collect()[1]
+            self.assertEqual(responses[('main.explore', 200)], 5)
+        self.assertNotIn(threads[0], metrics._shards)
+
+    def test_post_fragment_cache(self):
+        cache = self.app.fragment_cache
+        first = self.client.get('/explore').data
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(self.client.get('/explore').data, first)
+        self.assertEqual(cache.hits, self.app.config['POSTS_PER_PAGE'])
+
+        # a renamed author and an edited post are rendered again
+        user = User.query.filter_by(username='user1').first()
+        user.username = 'renamed'
+        post = Post.query.filter_by(body='post 0').first()
+        post.body = 'edited post'
+        db.session.commit()
+        page = self.client.get('/explore').data
+        self.assertIn(b'renamed', page)
+        self.assertIn(b'edited post', page)
+        self.assertNotIn(b'>post 0<', page)
+
+        # a change made by another worker, which doesn't drop this worker's entries, is rendered too
+        table = Post.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.id == post.id).values(
+                body='edited elsewhere'))
+        db.session.expire_all()
+        self.assertIn(b'edited elsewhere', self.client.get('/explore').data)
+
+
+    def test_translate_batch_route(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.translator_session = FakeTranslatorSession()
+        posts = Post.query.order_by(Post.id).limit(3).all()
+        response = self.client.post('/translate/batch', json={'items': [
+            {'post_id': posts[0].id, 'source_language': 'es', 'dest_language': 'en'},
+            {'post_id': posts[1].id, 'source_language': 'es', 'dest_language': 'en'},
+            {'post_id': posts[2].id, 'source_language': 'fr', 'dest_language': 'en'},
+            {'post_id': 12345, 'source_language': 'fr', 'dest_language': 'en'}]})
+        self.assertEqual(response.get_json(), {'translations': {
+            str(post.id): post.body.upper() for post in posts}})
+        self.assertEqual(len(self.app.translator_session.calls), 2)
+
+        # malformed bodies are a 400, malformed items are skipped
+        for body in ['not json', '[1, 2]', '{"items": "abc"}', '{}']:
+            response = self.client.post('/translate/batch', data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/translate/batch', json={'items': [
+            'abc', {'post_id': [1]}, {'post_id': 'x'}, {'post_id': posts[1].id, 'dest_language': 'en'},
+            {'post_id': str(posts[0].id), 'source_language': 'es', 'dest_language': 'en'}]})
+        self.assertEqual(response.get_json(), {'translations': {
+            str(posts[0].id): posts[0].body.upper()}})
+
+
+class SearchQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.search_queue.max_backoff = 0.01
+        self.app.elasticsearch = FakeElasticsearch(fail=1)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_queue_coalesces_and_retries(self):
+        queue = self.app.search_queue
+        start, queue.start = queue.start, lambda: None # hold the worker back until every change is queued
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        p1.body = 'first, edited'
+        db.session.commit()
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(len(queue), 4)
+        start()
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(len(self.app.elasticsearch.requests), 1)
+
+        # the first bulk request fails, the retry carries only the latest state of each post
+        actions = [action for request in self.app.elasticsearch.requests
+                   for action in request]
+        self.assertIn({'delete': {'_index': 'post', '_type': 'post',
+                                  '_id': p2.id}}, actions)
+        bodies = [a['body'] for a in actions if 'body' in a]
+        self.assertEqual(bodies, ['first, edited'])
+
+
+    def test_one_drainer_per_file(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        class FileQueueConfig(TestConfig):
+            SEARCH_QUEUE_PATH = os.path.join(tmp.name, 'queue.db')
+
+        first, second = create_app(FileQueueConfig), create_app(FileQueueConfig)
+        for app in (first, second):
+            app.elasticsearch = FakeElasticsearch()
+            app.search_queue.start = lambda: None
+        first.search_queue.add('post', 1, {'body': 'one'})
+        second.search_queue.add('post', 1, {'body': 'two'})
+        self.assertEqual(first.search_queue.drain_once(), 2)
+        second.search_queue.add('post', 2, {'body': 'three'})
+        self.assertEqual(second.search_queue.drain_once(), 0) # the first one drains this file
+        self.assertEqual(first.search_queue.drain_once(), 1)
+        self.assertEqual(second.elasticsearch.requests, [])
+
+        # a change either process makes expires the searches both have cached
+        self.assertEqual(second.search_cache.generation('post'), first.search_cache.generation('post'))
+        generation = second.search_cache.generation('post')
+        first.search_cache.invalidate('post')
+        self.assertEqual(second.search_cache.generation('post'), generation + 1)
+        self.assertEqual(first.elasticsearch.refresh, 'wait_for') # and bumps only once the batch is searchable
+
+    def test_reindex_resumes_from_checkpoint(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='post {}'.format(i), author=u)
+                                  for i in range(5)])
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+        es = self.app.elasticsearch = FakeElasticsearch(fail=0)
+
+        self.assertEqual(Post.reindex(chunk_size=2, workers=2), 5)
+        self.assertEqual(len(es.requests), 3)
+        self.assertEqual(self.app.search_queue.checkpoint('post'), 5)
+        self.assertEqual(Post.reindex(chunk_size=2, resume=True), 0)
+
+        # a failed chunk leaves the checkpoint after the last chunk that made it
+        self.app.search_queue.set_checkpoint('post', 0)
+        es.fail = 1
+        with self.assertRaises(SearchIndexError):
+            Post.reindex(chunk_size=2)
+        self.assertEqual(self.app.search_queue.checkpoint('post'), 0)
+        self.assertEqual(Post.reindex(chunk_size=2, resume=True), 5)
+
+
+class SQLiteSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'index.db')
+
+        class SQLiteSearchConfig(TestConfig):
+            SEARCH_BACKEND = 'sqlite'
+            SEARCH_INDEX_PATH = path
+            SEARCH_CACHE_STALENESS = 0
+
+        self.app = create_app(SQLiteSearchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='cat cat cat', author=u)
+        p3 = Post(body='a dog', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual((posts, total), ([p2, p1], 2))
+        posts, total = Post.search('Dog, mat!', 1, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts), 1)
+
+        db.session.delete(p2)
+        p3.body = 'a cat'
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(set(posts), {p1, p3})
+
+
+    def test_search_skips_missing_rows(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='cat one', author=u)
+        p2 = Post(body='cat cat two', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+
+        # p2 is gone from the database but still in the index
+        db.session.execute(Post.__table__.delete().where(Post.id == p2.id))
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual((posts, total), ([p1], 2))
+        self.assertIn('author', p1.__dict__)
+
+
+    def test_search_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='cat {}'.format(i), author=u)
+                                  for i in range(5)])
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+        backend = self.app.search_backend
+        calls = []
+        query = backend.query
+        backend.query = lambda *args: calls.append(args) or query(*args)
+
+        # one backend call fetches a window of pages, the next page is served from it
+        page1, total = Post.search('cat', 1, 2)
+        page2, total = Post.search('Cat', 2, 2)
+        self.assertEqual(total, 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(page1 + page2)), 4)
+
+        # a commit bumps the generation, the window is refetched once it is older than the staleness bound
+        db.session.add(Post(body='cat 5', author=u))
+        db.session.commit()
+        self.assertTrue(self.app.search_queue.join(timeout=5))
+        posts, total = Post.search('cat', 1, 2)
+        self.assertEqual((total, len(calls)), (6, 2))
+
+
+class BenchmarkCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def graph(self):
+        return sorted(db.session.execute(followers.select()).fetchall())
+
+    def test_generate_is_seeded(self):
+        benchmark.generate(20, 50, seed=1)
+        graph = self.graph()
+        bodies = [p.body for p in Post.query.order_by(Post.id)]
+        self.assertEqual(Post.query.count(), 50)
+        db.drop_all()
+        db.create_all()
+        benchmark.generate(20, 50, seed=1)
+        self.assertEqual(self.graph(), graph)
+        self.assertEqual([p.body for p in Post.query.order_by(Post.id)], bodies)
+
+    def test_compare(self):
+        baseline = {'results': {'10x10': {'index': {'median_ms': 10, 'queries': 3}}}}
+        current = {'results': {'10x10': {'index': {'median_ms': 11, 'queries': 3}}}}
+        self.assertEqual(benchmark.compare(baseline, current, 0.2), [])
+        current['results']['10x10']['index'] = {'median_ms': 13, 'queries': 4}
+        self.assertEqual(len(benchmark.compare(baseline, current, 0.2)), 2)
+
+
+class ProfilerCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class ProfileConfig(TestConfig):
+            PROFILE_ENABLED = True
+            PROFILE_SAMPLE_RATE = 0
+            PROFILE_DIR = self.tmp.name
+            PROFILE_MAX_FILES = 2
+
+        self.app = create_app(ProfileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_profiles(self):
+        client = self.app.test_client()
+        client.get('/auth/login')
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+        token = profile_token(self.app.config['SECRET_KEY'])
+        client.get('/auth/login', headers={'X-Profile': 'forged'})
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        for i in range(3):
+            client.get('/auth/login', headers={'X-Profile': token})
+            time.sleep(0.01)
+        files = os.listdir(self.tmp.name)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(f.endswith('.pstats') and '-auth.login-' in f for f in files))
+        pstats.Stats(os.path.join(self.tmp.name, files[0]))
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.primary = os.path.join(self.tmp.name, 'primary.db')
+        self.replica = os.path.join(self.tmp.name, 'replica.db')
+        self.app = self.create_app(['sqlite:///' + self.replica])
+
+    def create_app(self, replicas):
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+            SQLALCHEMY_REPLICA_URIS = replicas
+            WTF_CSRF_ENABLED = False
+
+        app = create_app(ReplicaConfig)
+        with app.app_context():
+            db.create_all()
+            if not User.query.count():
+                u = User(username='susan', email='susan@example.com')
+                u.set_password('cat')
+                db.session.add(u)
+                db.session.commit()
+                shutil.copy(self.primary, self.replica) # "replicated"
+                with app.replicas.replicas[0].engine.begin() as connection: # and one row only the replica has
+                    connection.execute(Post.__table__.insert().values(
+                        body='replica only', user_id=u.id, timestamp=datetime.utcnow()))
+            db.session.remove()
+        return app
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def login(self, app):
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        return client
+
+    def test_routing(self):
+        client = self.login(self.app)
+        self.assertIn(b'replica only', client.get('/explore').data)
+
+        # a write pins the browser to the primary for a while
+        client.post('/index', data={'post': 'fresh post'})
+        page = client.get('/explore').data
+        self.assertIn(b'fresh post', page)
+        self.assertNotIn(b'replica only', page)
+
+        # an unreachable replica falls back to the primary
+        app = self.create_app(['sqlite:///' + os.path.join(self.tmp.name, 'missing', 'x.db')])
+        page = self.login(app).get('/explore')
+        self.assertEqual(page.status_code, 200)
+        self.assertIn(b'fresh post', page.data)
+        self.assertFalse(app.replicas.replicas[0].healthy)
+
+    def test_one_replica_per_request(self):
+        app = self.create_app(['sqlite:///' + self.replica] * 2)
+        used = []
+        for replica in app.replicas.replicas:
+            db.event.listen(replica.engine, 'before_cursor_execute', # health checks aside
+                            lambda conn, cursor, statement, *args, replica=replica:
+                            statement != 'SELECT 1' and used.append(replica))
+        client = self.login(app)
+        for i in range(10):
+            del used[:]
+            self.assertIn(b'replica only', client.get('/explore?page=1').data) # the posts and their count
+            self.assertGreater(len(used), 1)
+            self.assertEqual(len(set(used)), 1)
+
+        # writes go to the primary even from a read only request, and so do the reads after them
+        with app.test_request_context('/explore'):
+            g.read_only = True
+            self.assertEqual(Post.query.filter_by(body='replica only').count(), 1)
+            self.assertEqual(db.session.execute(Post.__table__.update().where( # no such row on the primary
+                Post.body == 'replica only').values(body='x')).rowcount, 0)
+            db.session.execute(Post.__table__.insert().values(
+                body='changed', user_id=1, timestamp=datetime.utcnow()))
+            db.session.commit()
+            self.assertEqual(Post.query.filter_by(body='changed').count(), 1)
+            self.assertEqual(Post.query.filter_by(body='replica only').count(), 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)